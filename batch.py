@@ -0,0 +1,301 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import unicodedata
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+# 一括出金のデフォルト設定 (rate_per_minute は機器の払い出し速度に合わせる)
+# 台帳の記録は ledger_ttl_days 日で期限切れにする (毎月同じ内容のファイルを同じ名前で出しても出金される)
+DEFAULT_BATCH = {
+    "rate_per_minute": 6,
+    "ledger_path": "batch_ledger.jsonl",
+    "ledger_ttl_days": 20
+}
+
+# アップロードされたCSVの文字コード (Excelで保存したShift_JISのファイルも読めるようにする)
+BATCH_ENCODINGS = ["utf-8-sig", "cp932"]
+
+# 一括出金CSVの列
+BATCH_COLUMNS = ['応対者名', 'お支払先', '勘定項目', '出金金額']
+
+# 台帳の状態 (sent は出金要求を送ったが結果が記録されていないもの)
+LEDGER_SENT = "sent"
+LEDGER_DONE = "done"
+LEDGER_FAILED = "failed"
+
+
+# 実行できる行がないときの戻り値
+def empty_batch(message):
+    valid = pd.DataFrame({column: pd.Series(dtype=str) for column in BATCH_COLUMNS})
+    valid['出金金額'] = valid['出金金額'].astype('int64')
+    return valid, pd.DataFrame({"行": [1], "エラー": [message]})
+
+
+# アップロードされたCSV (バイト列) を読み込んで検証する
+# 戻り値は (実行できる行, エラーの一覧)、行番号はファイルの行 (ヘッダーが1行目)
+# 読めないファイルも例外にせずエラーの一覧で返す
+def validate_batch(content, account_items):
+    for encoding in BATCH_ENCODINGS:
+        try:
+            text = content.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        return empty_batch("文字コードを読み取れません (UTF-8かShift_JISで保存してください)")
+    try:
+        df = pd.read_csv(io.StringIO(text), dtype=str, keep_default_na=False)
+    except pd.errors.EmptyDataError:
+        return empty_batch("ファイルが空です")
+    except pd.errors.ParserError as e:
+        return empty_batch(f"CSVとして読み込めません: {e}")
+    missing = [column for column in BATCH_COLUMNS if column not in df.columns]
+    if missing:
+        return empty_batch(f"列がありません: {', '.join(missing)}")
+
+    df = df[BATCH_COLUMNS].apply(lambda column: column.str.strip())
+    df.index = pd.RangeIndex(2, len(df) + 2, name="行")
+    amounts = pd.to_numeric(df['出金金額'], errors='coerce')
+
+    checks = [
+        (df['応対者名'] == '', "応対者名を入力してください"),
+        (df['お支払先'] == '', "お支払先を入力してください"),
+        (~df['勘定項目'].isin(account_items), "勘定項目が不正です"),
+        (amounts.isna() | (amounts % 1 != 0), "出金金額は数値を入力してください"),
+        (amounts <= 0, "出金金額は0より大きい値を入力してください")
+    ]
+    errors = pd.concat(
+        [pd.DataFrame({"行": df.index[mask], "エラー": message}) for mask, message in checks],
+        ignore_index=True
+    ).sort_values("行", kind="stable")
+
+    valid = df[~df.index.isin(errors["行"])].copy()
+    valid['出金金額'] = amounts[valid.index].astype('int64')
+    return valid, errors
+
+
+# 比較のために値をそろえる (全角・半角と前後・連続する空白の違いを無視する)
+def normalize_value(value):
+    return " ".join(unicodedata.normalize("NFKC", str(value)).split())
+
+
+# 行ごとの冪等キー
+# バッチ名と行の内容 (応対者名, お支払先, 勘定項目, 出金金額)、同じ内容の行の何件目かから作るので、
+# エラーの行を直したり保存し直したりしたファイルを再実行しても、出金済みの行は同じキーになる
+def batch_keys(batch_name, valid):
+    occurrences = {}
+    keys = []
+    for _, item in valid.iterrows():
+        content = (
+            normalize_value(batch_name),
+            *(normalize_value(item[column]) for column in BATCH_COLUMNS[:3]),
+            int(item['出金金額'])
+        )
+        occurrences[content] = occurrences.get(content, 0) + 1
+        digest = hashlib.sha1(json.dumps([*content, occurrences[content]], ensure_ascii=False).encode('utf-8'))
+        keys.append(digest.hexdigest()[:24])
+    return keys
+
+
+# 一括出金の台帳 (出金要求の前後に追記し、再実行時の二重出金を防ぐ)
+# ttl_days 日より前の記録は期限切れとして扱い、同じキーの行も新しい出金として実行する
+class BatchLedger:
+    def __init__(self, path, ttl_days=None):
+        self.path = path
+        self.ttl = timedelta(days=ttl_days) if ttl_days else None
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry['key']] = entry
+
+    # 期限内の記録か
+    def _current(self, entry):
+        if entry is None or self.ttl is None:
+            return entry
+        if datetime.now() - datetime.strptime(entry['at'], '%Y-%m-%d %H:%M:%S') > self.ttl:
+            return None
+        return entry
+
+    # キーごとの最新の記録を返す (期限切れの記録は含めない)
+    def load(self):
+        with self.lock:
+            return {key: entry for key, entry in self.entries.items() if self._current(entry) is not None}
+
+    # 記録を追記してディスクに書き出す (ロックを取った状態で呼ぶ)
+    def _append(self, key, state, fields):
+        entry = {"key": key, "state": state, "at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'), **fields}
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[key] = entry
+        return entry
+
+    def record(self, key, state, **fields):
+        with self.lock:
+            return self._append(key, state, fields)
+
+    # 出金要求を送る前に行を確保する (未実行か前回失敗した行だけ確保できる)
+    def claim(self, key, **fields):
+        with self.lock:
+            entry = self._current(self.entries.get(key))
+            if entry is not None and entry['state'] != LEDGER_FAILED:
+                return False
+            self._append(key, LEDGER_SENT, fields)
+            return True
+
+
+# 出金要求の間隔を空ける (同じ機器への一括出金はセッションをまたいで共有する)
+class RateLimiter:
+    def __init__(self, rate_per_minute):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute else 0
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    # 次に送ってよい時刻まで待つ
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(self.next_at - now, 0)
+            self.next_at = max(self.next_at, now) + self.interval
+        if delay:
+            time.sleep(delay)
+
+
+# 台帳で出金済みになっている行 (実行するとスキップされる行) の {キー: 記録}
+def done_entries(ledger, keys):
+    entries = ledger.load()
+    return {key: entries[key] for key in keys if key in entries and entries[key]['state'] == LEDGER_DONE}
+
+
+# 一括出金を実行する
+# 台帳で実行済みの行は出金せず、送信済みで結果が不明な行は要確認として止める
+# 結果が不明になった行は1件ずつの出金と同じく要確認の取引として保存する
+# 出金できた行はその場で save に渡して保存する (途中で止まっても出金済みの行は記録に残る)
+# inventoryを渡すと出金前に釣銭の在庫で払い出せるかを確認する
+def run_batch(valid, keys, withdraw, ledger, limiter, machine_id, save, existing_uuids=None,
+              inventory=None, on_progress=None):
+    # 実行状況の表示だけならrequestsを読み込まないよう、APIクライアントのモジュールは実行時に読み込む
+    from cashpoint_client import is_unknown_result
+    entries = ledger.load()
+    results = []
+    done_uuids = [
+        entries[key]['uuid'] for key in keys
+        if key in entries and entries[key]['state'] == LEDGER_DONE
+    ]
+    saved = existing_uuids(done_uuids) if existing_uuids and done_uuids else set(done_uuids)
+
+    for count, (key, (row, item)) in enumerate(zip(keys, valid.iterrows()), start=1):
+        entry = entries.get(key)
+        record = {
+            "日時": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "応対者名": item['応対者名'],
+            "お支払先": item['お支払先'],
+            "勘定項目": item['勘定項目'],
+            "出金金額": int(item['出金金額']),
+            "ステータス": "出金処理中",
+            "機器ID": machine_id
+        }
+
+        if entry is not None and entry['state'] == LEDGER_DONE:
+            # 前回出金済み (保存前に中断していれば今回保存する)
+            if entry['uuid'] not in saved:
+                save({**record, "日時": entry['at'], "UUID": entry['uuid']})
+            result, uuid, message = "実行済み", entry['uuid'], f"{entry['at']} に出金済みのためスキップしました"
+        elif entry is not None and entry['state'] == LEDGER_SENT:
+            result, uuid, message = "要確認", None, "前回の実行で結果が記録されていません。機器の出金履歴を確認してください"
+        else:
+            # 待っている間に止まっても送信済みの行が残らないよう、行は待ったあと出金の直前に確保する
+            limiter.wait()
+            if inventory is not None:
+                payable, reservation, message = inventory.reserve(int(item['出金金額']))
+            else:
+                payable, reservation, message = True, None, ""
+            if not payable:
+                result, uuid = "失敗", None
+            elif not ledger.claim(key, row=int(row), amount=int(item['出金金額'])):
+                # 別のセッションが同じ行を実行中
+                if inventory is not None:
+                    inventory.release(reservation)
+                result, uuid, message = "要確認", None, "同じ行が別の実行で処理されています"
+            else:
+                success, uuid, message = withdraw(int(item['出金金額']))
+                if success and uuid:
+                    ledger.record(key, LEDGER_DONE, uuid=uuid)
+                    save({**record, "UUID": uuid})
+                    result = "出金"
+                elif is_unknown_result(message):
+                    # 機器に届いたか分からないので送信済みのまま残し、再実行でも出金しない
+                    # 在庫の確保も戻さず、要確認の取引として記録する
+                    save({**record, "UUID": None, "ステータス": "要確認"})
+                    result = "要確認"
+                else:
+                    if inventory is not None:
+                        inventory.release(reservation)
+                    ledger.record(key, LEDGER_FAILED, message=message)
+                    result = "失敗"
+
+        results.append({
+            "行": row, "応対者名": item['応対者名'], "出金金額": int(item['出金金額']),
+            "結果": result, "UUID": uuid, "メッセージ": message
+        })
+        if on_progress:
+            on_progress(count, len(valid))
+    return pd.DataFrame(results)
+
+
+# 一括出金をバックグラウンドで実行するスレッド
+# 画面の操作でスクリプトが再実行されても止まらず、進み具合と結果は画面から読む
+class BatchJob(threading.Thread):
+    def __init__(self, name, total, run):
+        super().__init__(name=f"batch-{name}", daemon=True)
+        self.run_batch = run
+        self.total = total
+        self.done = 0
+        self.results = None
+        self.error = None
+        self.started_at = datetime.now()
+        self.finished_at = None
+
+    def _progress(self, done, total):
+        self.done = done
+
+    def run(self):
+        try:
+            self.results = self.run_batch(self._progress)
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.finished_at = datetime.now()
+
+
+# 機器ごとの一括出金 (同じ機器では同時に1つだけ実行する)
+class BatchJobs:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    # 実行を始める (同じ機器で実行中ならNone)
+    def start(self, machine_id, total, run):
+        with self.lock:
+            job = self.jobs.get(machine_id)
+            if job is not None and job.is_alive():
+                return None
+            job = BatchJob(machine_id, total, run)
+            self.jobs[machine_id] = job
+            job.start()
+            return job
+
+    # 実行中か最後に実行した一括出金
+    def get(self, machine_id):
+        with self.lock:
+            return self.jobs.get(machine_id)
@@ -0,0 +1,428 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from cashpoint_client import CashPointClient
+from device_cache import DeviceInfoCache
+from history import HistoryArchive, archive_closed_months, history_filter_options, query_history
+from mock_server import MockCashPoint
+from reconcile import map_device_status, reconcile_statuses
+from storage import CachedTransactionLoader, SqliteTransactionStore, latest_page
+
+# 性能測定のデフォルト設定
+# mock は測定に使う代わりのサーバーの設定 (mock_server.DEFAULT_MOCK と同じ形式)
+# withdrawal_timeout 秒たってもステータスが確定しない出金は打ち切って失敗に数える
+DEFAULT_BENCHMARK = {
+    "output_dir": "benchmarks",
+    "withdrawals": 20,
+    "poll_interval": 0.05,
+    "withdrawal_timeout": 10,
+    "pending": [100, 1000],
+    "reconcile_workers": 8,
+    "history_rows": [10000, 100000, 1000000],
+    "repeat": 5,
+    "dashboard_runs": 5,
+    "mock": {
+        "latency": {
+            "default": {"dist": "lognormal", "median": 0.005, "sigma": 0.5},
+            "/api/refund": {"dist": "lognormal", "median": 0.02, "sigma": 0.5}
+        },
+        "transitions": [["processing", 0], ["Success", 0.2]],
+        "seed": 0
+    }
+}
+
+# 比較で遅くなったとみなす比率
+REGRESSION_RATIO = 1.2
+
+BENCHMARK_OPERATORS = ['山田', '佐藤', '鈴木', '田中', '高橋', '伊藤', '渡辺', '中村']
+BENCHMARK_PAYEES = ['株式会社A', '株式会社B', '有限会社C', 'D商店', 'E交通']
+BENCHMARK_ITEMS = ['会議費', '交通費', '接待費', '消耗品費', 'その他']
+
+
+# 計測値をまとめる (秒)
+def summarize(times):
+    values = np.array(times, dtype=float)
+    return {
+        "n": len(values),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(values.max())
+    }
+
+
+# 同じ処理を繰り返して時間を計る (最初の戻り値も返す)
+def measure(func, repeat):
+    times = []
+    result = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        value = func()
+        times.append(time.perf_counter() - started)
+        if i == 0:
+            result = value
+    return summarize(times), result
+
+
+# 出金の往復時間 (出金要求から確定したステータスを照会で確認できるまで)
+# timeout 秒以内に確定しなければ照会をやめ、失敗 (うちタイムアウト) として数える
+def bench_withdrawal(client, count, poll_interval, timeout=10):
+    refund_times = []
+    round_trips = []
+    failures = 0
+    timeouts = 0
+    for _ in range(count):
+        started = time.perf_counter()
+        success, uuid, _ = client.refund(1000)
+        refund_times.append(time.perf_counter() - started)
+        if not success:
+            failures += 1
+            continue
+        deadline = started + timeout
+        while True:
+            success, status = client.query(uuid)
+            if success and map_device_status(status):
+                round_trips.append(time.perf_counter() - started)
+                break
+            if time.perf_counter() + poll_interval > deadline:
+                failures += 1
+                timeouts += 1
+                break
+            time.sleep(poll_interval)
+    return {
+        "refund": summarize(refund_times),
+        "round_trip": summarize(round_trips) if round_trips else None,
+        "failures": failures,
+        "timeouts": timeouts
+    }
+
+
+# 未完了がN件あるときの照合の処理量
+def bench_reconcile(mock, client, sizes, max_workers):
+    results = {}
+    for size in sizes:
+        pending = {mock.refund(1): "default" for _ in range(size)}
+        # 機器側のステータスが確定するのを待ってから照会する
+        time.sleep(sum(step[1] for step in mock.config["transitions"]))
+        started = time.perf_counter()
+        result = reconcile_statuses(lambda uuid, machine_id: client.query(uuid), pending, max_workers)
+        elapsed = time.perf_counter() - started
+        results[str(size)] = {
+            "seconds": elapsed,
+            "per_second": size / elapsed,
+            "checked": result.checked,
+            "updated": len(result.updates),
+            "failures": len(result.failures)
+        }
+    return results
+
+
+# 測定用の取引を作る (過去1年に散らばらせ、処理中は当日分だけにする)
+def synthetic_transactions(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    now = pd.Timestamp.now().floor('s')
+    times = now - pd.to_timedelta(rng.integers(0, 365 * 24 * 3600, rows), unit='s')
+    statuses = rng.choice(['完了', '失敗'], rows, p=[0.95, 0.05]).astype(object)
+    statuses[(times >= now.normalize()) & (rng.random(rows) < 0.1)] = '出金処理中'
+    df = pd.DataFrame({
+        '日時': times.strftime('%Y-%m-%d %H:%M:%S'),
+        '応対者名': rng.choice(BENCHMARK_OPERATORS, rows),
+        'お支払先': rng.choice(BENCHMARK_PAYEES, rows),
+        '勘定項目': rng.choice(BENCHMARK_ITEMS, rows),
+        '出金金額': rng.integers(1, 100, rows) * 100,
+        'UUID': [f"bench-{i:08d}" for i in range(rows)],
+        'ステータス': statuses,
+        '機器ID': 'default'
+    })
+    return df.sort_values('日時', kind='stable').astype(object).to_dict('records')
+
+
+# 取引履歴の読み込みと絞り込み (件数ごとに新しいデータベースとアーカイブを作る)
+def bench_history(workdir, sizes, repeat, chunksize=50000):
+    results = {}
+    for rows in sizes:
+        path = os.path.join(workdir, f"history-{rows}")
+        os.makedirs(path)
+        store = SqliteTransactionStore(os.path.join(path, "transactions.db"))
+        try:
+            records = synthetic_transactions(rows)
+            started = time.perf_counter()
+            for start in range(0, rows, chunksize):
+                store.append_many(records[start:start + chunksize])
+            insert = time.perf_counter() - started
+            del records
+
+            month_ago = pd.Timestamp.now() - pd.Timedelta(days=30)
+            loader = CachedTransactionLoader(store)
+            result = {"insert_seconds": insert}
+            result["store_load"], _ = measure(store.load, repeat)
+            result["loader_cold"], _ = measure(lambda: CachedTransactionLoader(store).load(), repeat)
+            loader.load()
+            result["loader_warm"], _ = measure(loader.load, repeat)
+            result["store_filter"], filtered = measure(
+                lambda: store.query(start=month_ago, operators=['山田'], statuses=['完了']), repeat
+            )
+            result["store_filter_rows"] = len(filtered)
+
+            archive = HistoryArchive(os.path.join(path, "archive"))
+            started = time.perf_counter()
+            archive_closed_months(store, archive)
+            result["archive_seconds"] = time.perf_counter() - started
+            result["history_filter_options"], _ = measure(lambda: history_filter_options(store, archive), repeat)
+            result["history_all"], history = measure(lambda: query_history(store, archive), repeat)
+            result["history_page"], _ = measure(lambda: latest_page(history), repeat)
+            result["history_filter"], filtered = measure(
+                lambda: query_history(store, archive, operators=['山田'], statuses=['完了']), repeat
+            )
+            result["history_filter_rows"] = len(filtered)
+            result["rollups"], _ = measure(lambda: store.daily_rollups(start=month_ago), repeat)
+            results[str(rows)] = result
+        finally:
+            store.close()
+    return results
+
+
+# ダッシュボードの更新時間
+# 機器情報4項目の同時取得と、システム情報タブを表示するまでのスクリプト全体の実行時間を計る
+def bench_dashboard(mock, client, workdir, runs):
+    fetchers = {
+        "system_status": client.system_status,
+        "machine_info": client.machine_info,
+        "cash_info": client.cash_info,
+        "sensor_status": client.sensor_status
+    }
+    cache = DeviceInfoCache(fetchers)
+    names = list(fetchers)
+    result = {}
+    result["device_fetch"], _ = measure(lambda: cache.get_many(names, force=True), runs)
+    result["device_cached"], _ = measure(lambda: cache.get_many(names), runs)
+    cache.executor.shutdown()
+
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        return result
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    path = os.path.join(workdir, "dashboard")
+    os.makedirs(path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        with open("config.json", 'w') as f:
+            json.dump({"api_base_url": mock.base_url, "auth": {"username": "admin", "password": "0000"}}, f)
+        at = AppTest.from_file(app_path, default_timeout=60)
+        started = time.perf_counter()
+        at.run()
+        result["app_first_run"] = time.perf_counter() - started
+        at.sidebar.radio[0].set_value("システム情報")
+
+        def rerun():
+            at.run()
+            if at.exception:
+                raise RuntimeError(at.exception[0].value)
+
+        result["system_info_rerun"], _ = measure(rerun, runs)
+    finally:
+        os.chdir(cwd)
+    return result
+
+
+# 起動と再実行の時間を新しいプロセスで計るスクリプト (読み込み済みのモジュールの影響を受けないように)
+# 最初の実行 (メイン画面)、各タブを初めて開いたとき、各タブの再実行の時間と、最初の実行の区切りごとの時間を返す
+STARTUP_PROBE = """
+import json, statistics, sys, time
+app_path, runs = sys.argv[1], int(sys.argv[2])
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+from metrics import METRICS
+result = {"streamlit_import": time.perf_counter() - started, "first_visit": {}, "rerun": {}}
+
+def run(at):
+    started = time.perf_counter()
+    at.run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    return time.perf_counter() - started
+
+at = AppTest.from_file(app_path, default_timeout=60)
+result["first_run"] = run(at)
+result["first_run_phases"] = {
+    row["labels"].split("=", 1)[1]: row["mean_ms"] / 1000
+    for row in METRICS.summary() if row["name"] == "cashpoint_rerun_phase_seconds"
+}
+result["modules_after_first_run"] = sorted(
+    name for name in ("pandas", "pyarrow", "numpy", "requests") if name in sys.modules
+)
+tabs = at.sidebar.radio[0].options
+for tab in tabs[1:]:
+    at.sidebar.radio[0].set_value(tab)
+    result["first_visit"][tab] = run(at)
+for tab in tabs:
+    at.sidebar.radio[0].set_value(tab)
+    result["rerun"][tab] = statistics.median(run(at) for _ in range(runs))
+print(json.dumps(result))
+"""
+
+
+# 起動と再実行の時間 (設定ファイルと空のデータベースがある状態から起動する)
+def bench_startup(mock, workdir, runs):
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.join(workdir, "startup")
+    os.makedirs(path)
+    with open(os.path.join(path, "config.json"), 'w') as f:
+        json.dump({"api_base_url": mock.base_url, "auth": {"username": "admin", "password": "0000"}}, f)
+    SqliteTransactionStore(os.path.join(path, "transactions.db")).close()
+    completed = subprocess.run(
+        [sys.executable, "-c", STARTUP_PROBE, os.path.join(package_dir, "app.py"), str(runs)],
+        cwd=path, capture_output=True, text=True, check=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [package_dir, os.environ.get("PYTHONPATH")]))}
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+# 実行環境 (比較のときに条件がそろっているか確かめるため)
+def environment():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    versions = {"pandas": pd.__version__, "numpy": np.__version__}
+    for name in ("pyarrow", "requests", "streamlit"):
+        try:
+            versions[name] = __import__(name).__version__
+        except ImportError:
+            versions[name] = None
+    return {
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions
+    }
+
+
+# 測定をすべて行う
+def run_benchmarks(settings, suites):
+    mock = MockCashPoint(port=0, config=settings["mock"], sse=False).start()
+    client = CashPointClient(mock.base_url, pool_size=settings["reconcile_workers"], max_retries=0)
+    workdir = tempfile.mkdtemp(prefix="cashpoint-bench-")
+    results = {}
+    try:
+        if "withdrawal" in suites:
+            results["withdrawal"] = bench_withdrawal(
+                client, settings["withdrawals"], settings["poll_interval"], settings["withdrawal_timeout"]
+            )
+        if "reconcile" in suites:
+            results["reconcile"] = bench_reconcile(
+                mock, client, settings["pending"], settings["reconcile_workers"]
+            )
+        if "history" in suites:
+            results["history"] = bench_history(workdir, settings["history_rows"], settings["repeat"])
+        if "dashboard" in suites:
+            results["dashboard"] = bench_dashboard(mock, client, workdir, settings["dashboard_runs"])
+        if "startup" in suites:
+            results["startup"] = bench_startup(mock, workdir, settings["dashboard_runs"])
+    finally:
+        client.close()
+        mock.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+# 入れ子の結果を "history.100000.store_load.p50" のような平らなキーにする
+def flatten_results(results, prefix="", out=None):
+    out = {} if out is None else out
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flatten_results(value, name, out)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[name] = value
+    return out
+
+
+# 前回の結果と比べる (時間の指標だけを対象にし、遅くなったものに印をつける)
+def compare_results(previous, current, ratio=REGRESSION_RATIO):
+    before = flatten_results(previous["results"])
+    after = flatten_results(current["results"])
+    rows = []
+    for name, value in after.items():
+        old = before.get(name)
+        timed = (
+            name.endswith(("seconds", ".mean", ".p50", ".p95", ".max"))
+            or name.split(".")[-1].startswith("app_")
+            or name.startswith("startup.")
+        )
+        if old is None or not timed or old <= 0:
+            continue
+        rows.append({
+            "指標": name, "前回": old, "今回": value, "比率": value / old,
+            "判定": "遅化" if value / old > ratio else ""
+        })
+    return pd.DataFrame(rows, columns=["指標", "前回", "今回", "比率", "判定"])
+
+
+if __name__ == "__main__":
+    suites = ["withdrawal", "reconcile", "history", "dashboard", "startup"]
+    parser = argparse.ArgumentParser(description="代わりのサーバーを使った性能測定")
+    parser.add_argument("--suite", action="append", choices=suites, help="実行する測定 (省略時はすべて)")
+    parser.add_argument("--config", default=None, help="設定ファイル (JSON、DEFAULT_BENCHMARKと同じ形式)")
+    parser.add_argument("--rows", type=int, nargs="+", default=None, help="取引履歴の件数")
+    parser.add_argument("--pending", type=int, nargs="+", default=None, help="照合する未完了の件数")
+    parser.add_argument("--label", default=None, help="結果ファイルにつける名前")
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--compare", default=None, help="比べる前回の結果ファイル")
+    args = parser.parse_args()
+
+    settings = dict(DEFAULT_BENCHMARK)
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            settings.update(json.load(f))
+    if args.rows:
+        settings["history_rows"] = args.rows
+    if args.pending:
+        settings["pending"] = args.pending
+    output_dir = args.output_dir or settings["output_dir"]
+
+    started_at = datetime.now()
+    report = {
+        "label": args.label,
+        "started_at": started_at.strftime('%Y-%m-%d %H:%M:%S'),
+        "environment": environment(),
+        "settings": settings,
+        "results": run_benchmarks(settings, args.suite or suites)
+    }
+
+    os.makedirs(output_dir, exist_ok=True)
+    name = "-".join(filter(None, [args.label, report["environment"]["revision"], started_at.strftime('%Y%m%d-%H%M%S')]))
+    path = os.path.join(output_dir, f"{name}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {path}")
+
+    flat = flatten_results(report["results"])
+    for key in sorted(flat):
+        print(f"{key}: {flat[key]:.4f}" if isinstance(flat[key], float) else f"{key}: {flat[key]}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        comparison = compare_results(previous, report)
+        print(comparison.to_string(index=False))
+        if (comparison["判定"] == "遅化").any():
+            sys.exit(1)
@@ -0,0 +1,327 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from metrics import METRICS
+
+# HTTP接続のデフォルト設定
+# deadlines はエンドポイントごとの持ち時間 (秒、再試行を含む)
+# failure_threshold 回続けて接続に失敗したら遮断し、probe_interval 秒ごとに復旧を確認する
+DEFAULT_HTTP = {
+    "pool_size": 10,
+    "connect_timeout": 3.05,
+    "read_timeout": 10,
+    "max_retries": 3,
+    "backoff": 0.2,
+    "deadlines": {
+        "/api/login": 5,
+        "/api/refund": 15,
+        "/api/query": 5,
+        "/api/getErrorMessage": 5,
+        "/api/getStatus": 5,
+        "/api/machineInfo": 5,
+        "/api/cashInfo": 5,
+        "/api/sensorStatus": 5
+    },
+    "failure_threshold": 3,
+    "probe_interval": 5
+}
+
+# 再試行するHTTPステータス
+RETRY_STATUS = {500, 502, 503, 504}
+
+# 復旧の確認に使うエンドポイント
+PROBE_PATH = "/api/getStatus"
+
+# 出金要求が機器に届いたか分からない失敗のメッセージの先頭
+# 機器で払い出されている可能性があるので、再実行せずに機器の出金履歴を確認する
+UNKNOWN_RESULT = "出金結果不明"
+
+
+# 遮断中のため要求を送らなかったことを表す例外
+# 機器には届いていないので、出金を再実行しても二重にならない
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+# 接続エラーのメッセージ (遮断中はその旨を返す)
+def connection_error_message(e):
+    if isinstance(e, CircuitOpenError):
+        return str(e)
+    return f"API接続エラー: {str(e)}"
+
+
+# 要求を送ったあとの失敗か (応答待ちのタイムアウトや切断、機器側では処理されている可能性がある)
+# 遮断中・接続できなかった・接続のタイムアウトは送る前の失敗
+def request_may_have_been_sent(e):
+    if isinstance(e, (CircuitOpenError, requests.exceptions.ConnectTimeout)):
+        return False
+    if isinstance(e, requests.exceptions.ConnectionError):
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return not isinstance(reason, NewConnectionError)
+    return isinstance(e, requests.exceptions.Timeout)
+
+
+# 出金の結果が分からない失敗か (refundのメッセージで判定する)
+def is_unknown_result(message):
+    return message.startswith(UNKNOWN_RESULT)
+
+
+# 連続した接続失敗で要求を止める遮断器
+# 遮断中は要求を送らずにすぐ失敗させ、裏で復旧を確認して戻れば再開する
+class CircuitBreaker:
+    def __init__(self, probe, failure_threshold=3, probe_interval=5):
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.last_error = None
+        self.changed_at = time.time()
+        self.last_success = None
+        self.probing = False
+
+    # 要求を送ってよいか確認する (遮断中なら例外、復旧の確認がなければ始める)
+    def before_call(self):
+        with self.lock:
+            if self.state != "open":
+                return
+            self._start_probe()
+            error = self.last_error
+        raise CircuitOpenError(f"接続停止中: 機器に接続できません ({error})")
+
+    # 復旧の確認を始める (ロックを取った状態で呼ぶ、同時に1つだけ)
+    def _start_probe(self):
+        if self.probing:
+            return
+        self.probing = True
+        threading.Thread(target=self._probe_loop, name="api-probe", daemon=True).start()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.last_success = time.time()
+            if self.state != "closed":
+                self.state = "closed"
+                self.changed_at = time.time()
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.last_error = str(error)
+            if self.state == "closed" and self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.changed_at = time.time()
+                self._start_probe()
+
+    # 遮断中に定期的に復旧を確認する (遮断が解けたら確認中の印を外して終わる)
+    def _probe_loop(self):
+        while True:
+            with self.lock:
+                if self.state != "open":
+                    self.probing = False
+                    return
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception as e:
+                with self.lock:
+                    self.last_error = str(e)
+                continue
+            self.record_success()
+
+    # 現在の状態 (画面からすぐに確認できるよう、通信せずに返す)
+    def health(self):
+        with self.lock:
+            return {
+                "available": self.state == "closed",
+                "state": self.state,
+                "failures": self.failures,
+                "last_error": self.last_error,
+                "changed_at": self.changed_at,
+                "last_success": self.last_success
+            }
+
+
+# Cash Point APIクライアント (接続を使い回す)
+class CashPointClient:
+    def __init__(self, base_url, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 max_retries=3, backoff=0.2, deadlines=None, failure_threshold=3, probe_interval=5):
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.deadlines = {**DEFAULT_HTTP["deadlines"], **(deadlines or {})}
+        self.breaker = CircuitBreaker(self._probe, failure_threshold, probe_interval)
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    # 残りの持ち時間に収まるタイムアウト
+    def _timeout(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.exceptions.Timeout("持ち時間を超えました")
+        return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+    # 遮断中なら送らずに例外にする (送らなかった回数も数える)
+    def _before_call(self, path):
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            METRICS.inc("cashpoint_api_requests_total", path=path, outcome="circuit_open")
+            raise
+
+    # 応答を遮断器に記録する (接続できない・タイムアウト・5xxを失敗とみなす)
+    # 所要時間は再試行を含めた最初の送信からの時間
+    def _record(self, path, started, response=None, error=None):
+        METRICS.observe("cashpoint_api_request_seconds", time.perf_counter() - started, path=path)
+        if error is not None:
+            METRICS.inc("cashpoint_api_requests_total", path=path, outcome=type(error).__name__)
+            self.breaker.record_failure(error)
+            return
+        METRICS.inc("cashpoint_api_requests_total", path=path, outcome=str(response.status_code))
+        if response.status_code in RETRY_STATUS:
+            self.breaker.record_failure(f"HTTP {response.status_code}")
+        else:
+            self.breaker.record_success()
+
+    # 復旧の確認 (遮断器から呼ばれる)
+    def _probe(self):
+        deadline = time.monotonic() + self.deadlines.get(PROBE_PATH, self.read_timeout)
+        response = self.session.get(f"{self.base_url}{PROBE_PATH}", timeout=self._timeout(deadline))
+        if response.status_code in RETRY_STATUS:
+            raise requests.exceptions.HTTPError(f"HTTP {response.status_code}")
+
+    # POSTリクエストを送る (再試行しない)
+    def post(self, path, payload):
+        self._before_call(path)
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.deadlines.get(path, self.read_timeout)
+        try:
+            response = self.session.post(f"{self.base_url}{path}", json=payload, timeout=self._timeout(deadline))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            self._record(path, started, error=e)
+            raise
+        self._record(path, started, response)
+        response.raise_for_status()
+        return response.json()
+
+    # GETリクエストを送る (持ち時間の中でジッター付きバックオフで再試行する)
+    def get(self, path):
+        self._before_call(path)
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.deadlines.get(path, self.read_timeout)
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(f"{self.base_url}{path}", timeout=self._timeout(deadline))
+                if response.status_code in RETRY_STATUS and attempt < self.max_retries:
+                    raise requests.exceptions.RetryError(f"HTTP {response.status_code}")
+                self._record(path, started, response)
+                response.raise_for_status()
+                return response.json()
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.RetryError) as e:
+                delay = random.uniform(0, self.backoff * (2 ** attempt))
+                if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                    self._record(path, started, error=e)
+                    raise
+                METRICS.inc("cashpoint_api_retries_total", path=path)
+                time.sleep(delay)
+                attempt += 1
+
+    # 接続の状態 (通信せずに返す)
+    def health(self):
+        return self.breaker.health()
+
+    # APIにログインする
+    def login(self, username, password):
+        try:
+            data = self.post("/api/login", {"account": username, "password": password})
+            if data.get('isSuccess'):
+                return True, "ログインに成功しました"
+            else:
+                return False, f"ログインに失敗しました: {data.get('errorMsg', '不明なエラー')}"
+        except requests.exceptions.RequestException as e:
+            return False, connection_error_message(e)
+
+    # 出金処理を実行する
+    # 要求を送ったあとに応答が得られなかった場合は UNKNOWN_RESULT で始まるメッセージを返す
+    def refund(self, amount):
+        try:
+            data = self.post("/api/refund", {"amount": str(amount)})
+            if data.get('isSuccess'):
+                return True, data.get('data', {}).get('uuid', 'Unknown'), "出金処理が開始されました"
+            else:
+                return False, None, f"出金処理に失敗しました: {data.get('errorMsg', '不明なエラー')}"
+        except requests.exceptions.RequestException as e:
+            if request_may_have_been_sent(e):
+                return False, None, (
+                    f"{UNKNOWN_RESULT}: 機器で出金された可能性があります。"
+                    f"再実行する前に機器の出金履歴を確認してください ({str(e)})"
+                )
+            return False, None, connection_error_message(e)
+
+    # トランザクションステータスを確認する
+    def query(self, uuid):
+        try:
+            data = self.post("/api/query", {"uuid": uuid})
+            if data.get('isSuccess'):
+                info = data.get('data', {}).get('info', {})
+                status = info.get('status', 'Unknown')
+                return True, status
+            else:
+                return False, data.get('errorMsg', '不明なエラー')
+        except requests.exceptions.RequestException as e:
+            return False, connection_error_message(e)
+
+    # エラーメッセージを取得する
+    def error_message(self, error_code):
+        try:
+            data = self.post("/api/getErrorMessage", {"errorCode": error_code})
+            if data.get('isSuccess') or data.get('errorCode') == 200:
+                return True, data.get('data', '不明なエラー')
+            else:
+                return False, data.get('errorMsg', '不明なエラー')
+        except requests.exceptions.RequestException as e:
+            return False, connection_error_message(e)
+
+    # GETで情報を取得する
+    def fetch(self, path):
+        try:
+            data = self.get(path)
+            if data.get('isSuccess'):
+                return True, data.get('data', {})
+            else:
+                return False, data.get('errorMsg', '不明なエラー')
+        except requests.exceptions.RequestException as e:
+            return False, connection_error_message(e)
+
+    # システムステータスを取得する
+    def system_status(self):
+        return self.fetch("/api/getStatus")
+
+    # 機器情報を取得する
+    def machine_info(self):
+        return self.fetch("/api/machineInfo")
+
+    # 現金情報を取得する
+    def cash_info(self):
+        return self.fetch("/api/cashInfo")
+
+    # センサーステータスを取得する
+    def sensor_status(self):
+        return self.fetch("/api/sensorStatus")
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,159 @@
+import threading
+import time
+from math import gcd
+
+# 釣銭チェックのデフォルト設定 (既定では無効)
+# value_key / count_key は現金情報の各要素の金種と枚数のキー
+# 機器ごとに形式が違い、推測したキーで読み違えると出金を誤って止めてしまうので、
+# 両方を設定したときだけ確認する
+DEFAULT_CHANGE_CHECK = {
+    "enabled": False,
+    "resync_interval": 30,
+    "value_key": None,
+    "count_key": None
+}
+
+
+# 要素のキーの値を整数で返す (なければNone)
+def item_number(item, key):
+    try:
+        return int(item[key])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# 現金情報 (note / coin) から {金種: 枚数} を作る (読めなければNone)
+def parse_inventory(cash_info, value_key, count_key):
+    if not isinstance(cash_info, dict):
+        return None
+    inventory = {}
+    for kind in ("note", "coin"):
+        for item in cash_info.get(kind) or []:
+            if not isinstance(item, dict):
+                continue
+            value = item_number(item, value_key)
+            count = item_number(item, count_key)
+            if value and value > 0 and count is not None:
+                inventory[value] = inventory.get(value, 0) + max(count, 0)
+    return inventory or None
+
+
+# 在庫で払い出す金種の組み合わせを求める (払えなければNone)
+# 枚数に上限のある釣銭問題をビット集合の動的計画法で解き、大きい金種から多く使う組み合わせを返す
+def plan_change(inventory, amount):
+    denominations = sorted((d for d, c in inventory.items() if c > 0), reverse=True)
+    if amount == 0:
+        return {}
+    if not denominations or amount < 0 or amount > sum(d * inventory[d] for d in denominations):
+        return None
+    unit = 0
+    for denomination in denominations:
+        unit = gcd(unit, denomination)
+    if amount % unit:
+        return None
+    target = amount // unit
+    mask = (1 << (target + 1)) - 1
+
+    # reachable[i] は i 番目以降の金種で作れる金額の集合 (ビットkが立っていれば k*unit を作れる)
+    reachable = [1] * (len(denominations) + 1)
+    for i in range(len(denominations) - 1, -1, -1):
+        bits = reachable[i + 1]
+        step = denominations[i] // unit
+        remaining = min(inventory[denominations[i]], target // step)
+        chunk = 1
+        while remaining > 0:
+            take = min(chunk, remaining)
+            bits = (bits | (bits << (step * take))) & mask
+            remaining -= take
+            chunk *= 2
+        reachable[i] = bits
+    if not (reachable[0] >> target) & 1:
+        return None
+
+    plan = {}
+    rest = target
+    for i, denomination in enumerate(denominations):
+        step = denomination // unit
+        for count in range(min(inventory[denomination], rest // step), -1, -1):
+            if (reachable[i + 1] >> (rest - count * step)) & 1:
+                break
+        if count:
+            plan[denomination] = count
+            rest -= count * step
+    return plan
+
+
+# 機器の現金在庫の手元コピー
+# 出金前に払い出せるかを確認し、処理中の出金分は先に差し引いておく
+# 定期的に機器から取り直し、取り直しを始める前の差し引き分は機器の在庫に反映済みとみなす
+class ChangeInventory:
+    def __init__(self, fetch_cash_info, value_key, count_key, resync_interval=30):
+        self.fetch_cash_info = fetch_cash_info
+        self.resync_interval = resync_interval
+        self.value_key = value_key
+        self.count_key = count_key
+        self.lock = threading.Lock()
+        self.device = None
+        self.synced_at = None
+        self.reservations = []
+        self.syncing = None
+
+    # 機器から在庫を取り直す
+    def sync(self):
+        started = time.time()
+        success, cash_info = self.fetch_cash_info()
+        inventory = parse_inventory(cash_info, self.value_key, self.count_key) if success else None
+        with self.lock:
+            if inventory is not None:
+                self.device = inventory
+                self.synced_at = started
+                self.reservations = [r for r in self.reservations if r[0] >= started]
+            self.syncing = None
+        return inventory is not None
+
+    # 在庫が古ければバックグラウンドで取り直す (同時に1つだけ)
+    def resync_if_stale(self):
+        with self.lock:
+            if self.syncing is not None:
+                return
+            if self.synced_at is not None and time.time() - self.synced_at < self.resync_interval:
+                return
+            self.syncing = threading.Thread(target=self.sync, name="change-sync", daemon=True)
+            self.syncing.start()
+
+    # 処理中の出金を差し引いた在庫 (ロックを取った状態で呼ぶ)
+    def _available(self):
+        if self.device is None:
+            return None
+        inventory = dict(self.device)
+        for _, plan in self.reservations:
+            for denomination, count in plan.items():
+                inventory[denomination] = inventory.get(denomination, 0) - count
+        return inventory
+
+    def available(self):
+        with self.lock:
+            return self._available()
+
+    # 出金できるか確認して在庫を差し引く
+    # 戻り値は (出金できるか, 差し引いた組み合わせ, メッセージ)、在庫が不明なら確認せずに通す
+    def reserve(self, amount):
+        self.resync_if_stale()
+        with self.lock:
+            inventory = self._available()
+            if inventory is None:
+                return True, None, "在庫情報がないため釣銭の確認を省略しました"
+            plan = plan_change(inventory, amount)
+            if plan is None:
+                total = sum(d * c for d, c in inventory.items() if c > 0)
+                return False, None, f"釣銭不足のため {amount}円 は出金できません (払出可能な在庫合計: {total}円)"
+            reservation = (time.time(), plan)
+            self.reservations.append(reservation)
+            return True, reservation, ""
+
+    # 出金が失敗したときに差し引いた分を戻す
+    def release(self, reservation):
+        if reservation is None:
+            return
+        with self.lock:
+            self.reservations = [r for r in self.reservations if r is not reservation]
@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+# 機器IDのない取引・設定 (複数機器対応前の取引と1台構成) の機器ID
+DEFAULT_MACHINE_ID = "default"
+
+
+# 設定ファイルの内容を保持し、ファイルが変わったときだけ読み直す
+# 変更の確認 (stat) も check_interval 秒に1回までにする
+# 返す辞書は共有されるので、呼び出し側で書き換えないこと
+class ConfigFile:
+    def __init__(self, path, default=None, check_interval=1.0):
+        self.path = path
+        self.default = default or {}
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.config = None
+        self.signature = None
+        self.checked_at = 0.0
+
+    # ファイルの更新時刻とサイズ (ファイルがなければNone)
+    def _signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.config is not None and now - self.checked_at < self.check_interval:
+                return self.config
+            self.checked_at = now
+            signature = self._signature()
+            if self.config is None or signature != self.signature:
+                if signature is None:
+                    self.config = self.default
+                else:
+                    with open(self.path, 'r') as f:
+                        self.config = json.load(f)
+                self.signature = signature
+            return self.config
+
+    def exists(self):
+        return self._signature() is not None
+
+    # 書き出し途中のファイルを読まれないよう、一時ファイルから置き換える
+    def save(self, config):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".config-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(config, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            self.config = config
+            self.signature = self._signature()
+            self.checked_at = time.monotonic()
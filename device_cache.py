@@ -0,0 +1,82 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 機器情報キャッシュのデフォルト設定 (有効期限は秒)
+DEFAULT_DEVICE_CACHE = {
+    "ttl": {
+        "system_status": 5,
+        "machine_info": 300,
+        "cash_info": 10,
+        "sensor_status": 5
+    },
+    "max_workers": 4
+}
+
+
+# 機器情報のプロセス共有キャッシュ
+# 期限切れでも古い値をすぐ返して裏で更新し、同じ項目への同時要求は1回の問い合わせにまとめる
+class DeviceInfoCache:
+    def __init__(self, fetchers, ttl=None, max_workers=4):
+        self.fetchers = fetchers
+        self.ttl = {**DEFAULT_DEVICE_CACHE["ttl"], **(ttl or {})}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="device-cache")
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.inflight = {}
+
+    # 項目を問い合わせる (実行中の問い合わせがあればそれを返す)
+    def refresh(self, name):
+        with self.lock:
+            future = self.inflight.get(name)
+            if future is None:
+                future = self.executor.submit(self._fetch, name)
+                self.inflight[name] = future
+            return future
+
+    # 問い合わせて結果を保存する
+    def _fetch(self, name):
+        try:
+            success, value = self.fetchers[name]()
+        except Exception as e:
+            success, value = False, str(e)
+        with self.lock:
+            if success:
+                self.entries[name] = {"value": value, "fetched_at": time.time()}
+            del self.inflight[name]
+        return success, value
+
+    # 期限内の値があるか
+    def is_fresh(self, name):
+        entry = self.entries.get(name)
+        return entry is not None and time.time() - entry["fetched_at"] <= self.ttl.get(name, 0)
+
+    # 複数の項目を並列に取得する
+    # force=Trueなら新しい値を待ち、そうでなければ古い値を返しつつ裏で更新する
+    def get_many(self, names, force=False):
+        futures = {}
+        for name in names:
+            if force or not self.is_fresh(name):
+                futures[name] = self.refresh(name)
+
+        results = {}
+        for name in names:
+            entry = self.entries.get(name)
+            if name in futures and (force or entry is None):
+                results[name] = futures[name].result()
+            else:
+                results[name] = (True, entry["value"])
+        return results
+
+    # 1つの項目を取得する
+    def get(self, name, force=False):
+        return self.get_many([name], force=force)[name]
+
+    # 最後に取得できてからの秒数
+    def age(self, name):
+        entry = self.entries.get(name)
+        return None if entry is None else time.time() - entry["fetched_at"]
+
+    # 問い合わせのスレッドを止める (設定が変わって作り直すとき、実行中の問い合わせは済ませる)
+    def stop(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# エラーメッセージキャッシュのデフォルト設定
+DEFAULT_ERROR_CACHE = {
+    "ttl": 86400,
+    "max_entries": 1024,
+    "path": "cache",
+    "prefetch_ranges": [],
+    "prefetch_workers": 4
+}
+
+
+# エラーコードの範囲を展開する (例: ["001001", "001003"] → 001001, 001002, 001003)
+def expand_code_range(start, end):
+    width = len(start)
+    return [str(code).zfill(width) for code in range(int(start), int(end) + 1)]
+
+
+# エラーメッセージのキャッシュ (有効期限付き、古いものから追い出す)
+class ErrorMessageCache:
+    def __init__(self, fetch, ttl=86400, max_entries=1024, path=None):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.entries = OrderedDict()
+        self._read()
+
+    # 保存済みのキャッシュを読み込む
+    def _read(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for code, (message, fetched_at) in json.load(f).items():
+                    self.entries[code] = (message, fetched_at)
+
+    # キャッシュを保存する
+    def _write(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = dict(self.entries)
+        with self.write_lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(self.path + ".tmp", self.path)
+
+    # キャッシュ済みのメッセージを返す (期限切れや未取得ならNone)
+    def peek(self, code):
+        with self.lock:
+            entry = self.entries.get(code)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                return None
+            self.entries.move_to_end(code)
+            return entry[0]
+
+    # メッセージを登録する
+    def put(self, code, message):
+        with self.lock:
+            self.entries[code] = (message, time.time())
+            self.entries.move_to_end(code)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # エラーメッセージを取得する (キャッシュになければAPIに問い合わせる)
+    def get(self, code):
+        message = self.peek(code)
+        if message is not None:
+            return True, message
+        success, message = self.fetch(code)
+        if success:
+            self.put(code, message)
+            self._write()
+        return success, message
+
+    # 指定したコードをまとめて取得しておく
+    def prefetch(self, codes, max_workers=4):
+        codes = [code for code in codes if self.peek(code) is None]
+        if not codes:
+            return 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(self.fetch, codes))
+        fetched = 0
+        for code, (success, message) in zip(codes, results):
+            if success:
+                self.put(code, message)
+                fetched += 1
+        self._write()
+        return fetched
+
+    # 範囲指定のコードをバックグラウンドで取得しておく
+    def prefetch_ranges_async(self, ranges, max_workers=4):
+        codes = [code for start, end in ranges for code in expand_code_range(start, end)]
+        thread = threading.Thread(
+            target=self.prefetch, args=(codes, max_workers), name="error-prefetch", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+# 接続先ごとのキャッシュファイルのパスを返す
+def error_cache_path(directory, base_url):
+    digest = hashlib.sha1(base_url.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(directory, f"error_messages_{digest}.json")
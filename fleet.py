@@ -0,0 +1,86 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config_file import DEFAULT_MACHINE_ID
+
+# pandasは表を作る関数の中で読み込む (機器の一覧は再実行のたびに使うので、読み込みを軽くしておく)
+
+
+# 設定から機器の一覧を作る ("machines" がなければ従来の1台構成)
+def load_machines(config):
+    machines = config.get('machines')
+    if not machines:
+        return [{
+            "id": DEFAULT_MACHINE_ID,
+            "name": "既定の機器",
+            "api_base_url": config['api_base_url'],
+            "auth": config['auth']
+        }]
+    return [
+        {
+            "id": machine['id'],
+            "name": machine.get('name', machine['id']),
+            "api_base_url": machine['api_base_url'],
+            "auth": machine.get('auth', config.get('auth', {}))
+        }
+        for machine in machines
+    ]
+
+
+# 機器IDから機器を探す (見つからなければ先頭の機器)
+def find_machine(machines, machine_id):
+    for machine in machines:
+        if machine['id'] == machine_id:
+            return machine
+    return machines[0]
+
+
+# 全機器に同じ処理を並列に実行する (機器ごとの失敗や遅延は他の機器に影響しない)
+def fan_out(machines, func):
+    # 機器ごとの処理時間と結果を記録する
+    def run(machine):
+        started = time.perf_counter()
+        try:
+            result, error = func(machine), None
+        except Exception as e:
+            result, error = None, str(e)
+        return {"result": result, "error": error, "latency": time.perf_counter() - started}
+
+    if not machines:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(machines)) as executor:
+        return dict(zip([machine['id'] for machine in machines], executor.map(run, machines)))
+
+
+# 全機器の取得結果を一覧表にまとめる
+def fleet_summary(machines, snapshot):
+    rows = []
+    for machine in machines:
+        entry = snapshot[machine['id']]
+        results = entry['result'] or {}
+        errors = [f"{name}: {value}" for name, (success, value) in results.items() if not success]
+        if entry['error']:
+            errors.append(entry['error'])
+        rows.append({
+            "機器ID": machine['id'],
+            "機器名": machine['name'],
+            "状態": "エラー" if errors else "正常",
+            "応答時間(ms)": round(entry['latency'] * 1000),
+            "エラー": " / ".join(errors)
+        })
+    import pandas as pd
+    return pd.DataFrame(rows)
+
+
+# 全機器の紙幣・硬貨の在庫を1つの表にまとめる
+def fleet_cash_table(machines, snapshot, kind):
+    import pandas as pd
+    frames = []
+    for machine in machines:
+        results = snapshot[machine['id']]['result'] or {}
+        success, cash_info = results.get("cash_info", (False, None))
+        if success and isinstance(cash_info, dict) and cash_info.get(kind):
+            frame = pd.DataFrame(cash_info[kind])
+            frame.insert(0, "機器ID", machine['id'])
+            frames.append(frame)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
@@ -0,0 +1,326 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from reconcile import DEFAULT_BACKGROUND_RECONCILE
+from storage import DEFAULT_MACHINE_ID, TRANSACTION_COLUMNS, coerce_dtypes, open_store
+
+# アーカイブのデフォルト設定
+DEFAULT_ARCHIVE = {
+    "path": "archive",
+    "row_group_size": 50000
+}
+
+# カタログファイル名
+CATALOG_FILE = "_catalog.json"
+
+# アーカイブのスキーマ
+ARCHIVE_SCHEMA = pa.schema([
+    ('日時', pa.timestamp('us')),
+    ('応対者名', pa.string()),
+    ('お支払先', pa.string()),
+    ('勘定項目', pa.string()),
+    ('出金金額', pa.int64()),
+    ('UUID', pa.string()),
+    ('ステータス', pa.string()),
+    ('機器ID', pa.string()),
+])
+
+
+# エクスポート形式 (表示名: (形式, 圧縮, 拡張子, MIMEタイプ))
+EXPORT_FORMATS = {
+    "CSV": ("csv", None, ".csv", "text/csv"),
+    "CSV (gzip)": ("csv", "gzip", ".csv.gz", "application/gzip"),
+    "Parquet": ("parquet", None, ".parquet", "application/vnd.apache.parquet"),
+}
+if zstandard is not None:
+    EXPORT_FORMATS["CSV (zstd)"] = ("csv", "zstd", ".csv.zst", "application/zstd")
+
+
+# DataFrameをアーカイブと同じスキーマのArrowテーブルにする
+def to_archive_table(df):
+    return pa.Table.from_pandas(
+        df[TRANSACTION_COLUMNS].astype({
+            '日時': 'datetime64[us]', '応対者名': object, '勘定項目': object, 'ステータス': object,
+            '機器ID': object
+        }),
+        schema=ARCHIVE_SCHEMA,
+        preserve_index=False
+    )
+
+
+# 月の開始日時を返す
+def month_start(month):
+    return pd.Timestamp(f"{month}-01")
+
+
+# 翌月の開始日時を返す
+def month_end(month):
+    return month_start(month) + pd.offsets.MonthBegin(1)
+
+
+# 月ごとのParquetに分割した取引履歴のアーカイブ
+# 照合の終わった過去の月を古い順に書き出し、カタログに月ごとの概要を持つ
+class HistoryArchive:
+    def __init__(self, path, row_group_size=50000):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.catalog = self._read_catalog()
+
+    # カタログを読み込む
+    def _read_catalog(self):
+        catalog_path = os.path.join(self.path, CATALOG_FILE)
+        if os.path.exists(catalog_path):
+            with open(catalog_path, 'r') as f:
+                return json.load(f)
+        return {"months": {}}
+
+    # カタログを書き込む
+    def _write_catalog(self):
+        catalog_path = os.path.join(self.path, CATALOG_FILE)
+        with open(catalog_path + ".tmp", 'w') as f:
+            json.dump(self.catalog, f, ensure_ascii=False, indent=2)
+        os.replace(catalog_path + ".tmp", catalog_path)
+
+    # 月のファイルパスを返す
+    def month_path(self, month):
+        return os.path.join(self.path, f"month={month}", "data.parquet")
+
+    # アーカイブ済みの月の一覧
+    def months(self):
+        return sorted(self.catalog["months"])
+
+    # アーカイブ済みの範囲の終わり (この日時より前はアーカイブから読む)
+    def watermark(self):
+        months = self.months()
+        return month_end(months[-1]) if months else None
+
+    # 1か月分を書き出す
+    def write_month(self, month, df, rev=None):
+        df = df.sort_values('日時', kind='stable')
+        table = to_archive_table(df)
+        path = self.month_path(month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, path + ".tmp", row_group_size=self.row_group_size, compression='zstd')
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            self.catalog["months"][month] = {
+                "rows": len(df),
+                "rev": rev,
+                "min": df['日時'].min().strftime('%Y-%m-%d %H:%M:%S'),
+                "max": df['日時'].max().strftime('%Y-%m-%d %H:%M:%S'),
+                "operators": sorted(df['応対者名'].dropna().astype(str).unique().tolist()),
+                "statuses": sorted(df['ステータス'].dropna().astype(str).unique().tolist()),
+                "machines": sorted(df['機器ID'].dropna().astype(str).unique().tolist()),
+            }
+            self._write_catalog()
+
+    # 条件に合う行を読む (範囲外の月は開かず、行グループは統計情報で読み飛ばす)
+    def query(self, start=None, end=None, operators=None, statuses=None, machines=None):
+        dataset, condition = self._scan(start, end, operators, statuses, machines)
+        if dataset is None:
+            return coerce_dtypes(pd.DataFrame(columns=TRANSACTION_COLUMNS))
+        return coerce_dtypes(dataset.to_table(filter=condition).to_pandas())
+
+    # 条件に合う行を少しずつ読み出す
+    def iter_query(self, start=None, end=None, operators=None, statuses=None, machines=None,
+                   chunksize=50000):
+        dataset, condition = self._scan(start, end, operators, statuses, machines)
+        if dataset is None:
+            return
+        for batch in dataset.to_batches(filter=condition, batch_size=chunksize):
+            if batch.num_rows:
+                yield batch.to_pandas()
+
+    # 読み込むデータセットと絞り込み条件を作る
+    def _scan(self, start, end, operators, statuses, machines):
+        paths = [
+            self.month_path(month) for month in self.months()
+            if (end is None or month_start(month) < pd.Timestamp(end))
+            and (start is None or month_end(month) > pd.Timestamp(start))
+        ]
+        if not paths:
+            return None, None
+
+        condition = None
+        for expression in [
+            ds.field('日時') >= pa.scalar(pd.Timestamp(start), pa.timestamp('us')) if start is not None else None,
+            ds.field('日時') < pa.scalar(pd.Timestamp(end), pa.timestamp('us')) if end is not None else None,
+            ds.field('応対者名').isin(list(operators)) if operators else None,
+            ds.field('ステータス').isin(list(statuses)) if statuses else None,
+            machine_filter(machines) if machines else None,
+        ]:
+            if expression is not None:
+                condition = expression if condition is None else condition & expression
+
+        return ds.dataset(paths, schema=ARCHIVE_SCHEMA, format='parquet'), condition
+
+    # カタログから絞り込みの選択肢を返す (データは読まない)
+    def summary(self):
+        months = self.catalog["months"].values()
+        return {
+            "min": min((m["min"] for m in months), default=None),
+            "max": max((m["max"] for m in months), default=None),
+            "operators": sorted({o for m in months for o in m["operators"]}),
+            "statuses": sorted({s for m in months for s in m["statuses"]}),
+            "machines": sorted({i for m in months for i in m.get("machines", [DEFAULT_MACHINE_ID])}),
+        }
+
+
+# 機器IDの絞り込み条件 (機器IDのない古いアーカイブは既定の機器として扱う)
+def machine_filter(machines):
+    expression = ds.field('機器ID').isin(list(machines))
+    if DEFAULT_MACHINE_ID in machines:
+        expression = expression | ds.field('機器ID').is_null()
+    return expression
+
+
+# 締まった月 (当月より前で照合中の取引がない月) を古い順にアーカイブする
+# pending_deadline 秒より前の未完了の取引は照合をやめたものとして、そのままアーカイブする
+# (ステータスがあとで変わった月は変更番号が変わるので、次回に書き直される)
+def archive_closed_months(store, archive, now=None,
+                          pending_deadline=DEFAULT_BACKGROUND_RECONCILE["deadline"]):
+    now = now or datetime.now()
+    current_month = now.strftime('%Y-%m')
+    cutoff = (now - timedelta(seconds=pending_deadline)).strftime('%Y-%m-%d %H:%M:%S')
+    archived = 0
+    for summary in store.month_summaries():
+        month = summary['month']
+        if month >= current_month:
+            break
+        if summary['pending'] > 0 and (summary['pending_last'] is None or summary['pending_last'] >= cutoff):
+            break
+        entry = archive.catalog["months"].get(month)
+        if entry and entry["rows"] == summary['rows'] and entry["rev"] == summary['rev']:
+            continue
+        df = store.query(start=month_start(month), end=month_end(month))
+        archive.write_month(month, df, rev=summary['rev'])
+        archived += 1
+    return archived
+
+
+# 検索範囲をアーカイブ分とストレージ分に分ける
+def split_history_range(archive, start=None, end=None):
+    watermark = archive.watermark()
+    sources = []
+    recent_start = start
+    if watermark is not None and (start is None or pd.Timestamp(start) < watermark):
+        archive_end = watermark if end is None else min(pd.Timestamp(end), watermark)
+        sources.append(('archive', start, archive_end))
+        recent_start = watermark
+    if end is None or recent_start is None or pd.Timestamp(end) > pd.Timestamp(recent_start):
+        sources.append(('store', recent_start, end))
+    return sources
+
+
+# アーカイブとストレージをまたいで取引履歴を検索する
+def query_history(store, archive, start=None, end=None, operators=None, statuses=None,
+                  machines=None):
+    frames = []
+    for source, range_start, range_end in split_history_range(archive, start, end):
+        reader = archive if source == 'archive' else store
+        frames.append(reader.query(range_start, range_end, operators, statuses, machines))
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return coerce_dtypes(pd.DataFrame(columns=TRANSACTION_COLUMNS))
+    return coerce_dtypes(pd.concat(frames, ignore_index=True))
+
+
+# 絞り込みの選択肢を返す (アーカイブはカタログ、それ以降はストレージのインデックスから)
+def history_filter_options(store, archive):
+    summary = archive.summary()
+    recent = store.filter_options(start=archive.watermark())
+    dates = [
+        pd.Timestamp(value) for value in [summary["min"], summary["max"], recent["min"], recent["max"]]
+        if value is not None and pd.notna(value)
+    ]
+    return {
+        "min": min(dates).date() if dates else None,
+        "max": max(dates).date() if dates else None,
+        "operators": sorted(set(summary["operators"]) | set(recent["operators"])),
+        "statuses": sorted(set(summary["statuses"]) | set(recent["statuses"])),
+        "machines": sorted(set(summary["machines"]) | set(recent["machines"])),
+    }
+
+
+# 取引履歴を少しずつ読み出す (エクスポート用)
+def iter_history(store, archive, start=None, end=None, operators=None, statuses=None,
+                 machines=None, chunksize=50000):
+    for source, range_start, range_end in split_history_range(archive, start, end):
+        reader = archive if source == 'archive' else store
+        yield from reader.iter_query(range_start, range_end, operators, statuses, machines, chunksize)
+
+
+# 取引履歴を開いたバイナリファイルに少しずつ書き出す
+def export_history(chunks, f, fmt="csv", compression=None):
+    if fmt == "parquet":
+        with pq.ParquetWriter(f, ARCHIVE_SCHEMA, compression='zstd') as writer:
+            for chunk in chunks:
+                writer.write_table(to_archive_table(chunk))
+        return
+
+    if compression == "gzip":
+        raw = gzip.GzipFile(fileobj=f, mode='wb')
+    elif compression == "zstd":
+        raw = zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+    else:
+        raw = None
+    text = io.TextIOWrapper(raw or f, encoding='utf-8', newline='')
+    header = True
+    for chunk in chunks:
+        chunk[TRANSACTION_COLUMNS].to_csv(text, header=header, index=False)
+        header = False
+    if header:
+        pd.DataFrame(columns=TRANSACTION_COLUMNS).to_csv(text, index=False)
+    text.flush()
+    text.detach()
+    if raw is not None:
+        raw.close()
+
+
+# ダウンロード用のエクスポートを作成してバイト列で返す
+# 書き出しは一時ファイルへ少しずつ行うが、Streamlitは配信するためにファイル全体をメモリに持つので、
+# 返すバイト列 (出力したファイルの大きさ) の分はメモリを使う (大きな範囲は圧縮形式を選ぶ)
+# 一時ファイルは読み終えたら閉じて削除する
+def build_history_export(store, archive, start=None, end=None, operators=None, statuses=None,
+                         machines=None, format_name="CSV"):
+    fmt, compression, suffix, _ = EXPORT_FORMATS[format_name]
+    with tempfile.TemporaryFile(prefix="transaction_history_", suffix=suffix) as f:
+        chunks = iter_history(store, archive, start, end, operators, statuses, machines)
+        export_history(chunks, f, fmt, compression)
+        f.flush()
+        f.seek(0)
+        return f.read()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="取引履歴のアーカイブ")
+    parser.add_argument("--backend", default="sqlite")
+    parser.add_argument("--store", default="transactions.db")
+    parser.add_argument("--archive", default=DEFAULT_ARCHIVE["path"])
+    parser.add_argument("--pending-deadline", type=int, default=DEFAULT_BACKGROUND_RECONCILE["deadline"],
+                        help="この秒数より前の未完了の取引は照合をやめたものとしてアーカイブする")
+    args = parser.parse_args()
+
+    count = archive_closed_months(
+        open_store(args.backend, args.store), HistoryArchive(args.archive),
+        pending_deadline=args.pending_deadline
+    )
+    print(f"{count}か月分をアーカイブしました")
@@ -0,0 +1,157 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import METRICS
+
+# 書き込みジャーナルのデフォルト設定
+# 書き込みが続いている間もfsyncは flush_interval_ms ごとに1回にまとめる
+DEFAULT_JOURNAL = {
+    "flush_interval_ms": 20,
+    "max_batch": 1000
+}
+
+APPEND = "append"
+UPDATE = "update"
+
+
+# ストレージへの書き込みを1つのスレッドにまとめるジャーナル
+# 各セッションは書き込みをキューに入れて完了通知 (Future) を受け取り、書き込みスレッドがまとめてコミットする
+class TransactionJournal(threading.Thread):
+    def __init__(self, store, flush_interval_ms=20, max_batch=1000):
+        super().__init__(name="transaction-journal", daemon=True)
+        self.store = store
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopping = False
+
+    # 書き込みをキューに入れる (止めたあとの書き込みは受け付けない)
+    def _submit(self, kind, payload):
+        future = Future()
+        with self.lock:
+            if self.stopping:
+                raise RuntimeError("書き込みジャーナルは停止しています")
+            self.queue.put((kind, payload, future))
+        return future
+
+    # 追記を依頼する (結果は追記した件数)
+    def submit_append_many(self, records):
+        return self._submit(APPEND, list(records))
+
+    # ステータスの更新を依頼する (結果は同じ回にまとめて更新した件数)
+    def submit_update_statuses(self, updates):
+        return self._submit(UPDATE, dict(updates))
+
+    # 書き込みが終わるまで待つ (ストレージと同じ呼び出し方ができる)
+    # 待ち時間はキューで待った分とfsyncまでを含む
+    def append(self, record):
+        with METRICS.timer("cashpoint_journal_wait_seconds", operation="append"):
+            return self.submit_append_many([record]).result()
+
+    def append_many(self, records):
+        with METRICS.timer("cashpoint_journal_wait_seconds", operation="append_many"):
+            return self.submit_append_many(records).result()
+
+    def update_statuses(self, updates):
+        with METRICS.timer("cashpoint_journal_wait_seconds", operation="update_statuses"):
+            return self.submit_update_statuses(updates).result()
+
+    # キューにたまっている書き込みを集める (block=Trueなら1件届くまで待つ)
+    def _collect(self, block):
+        try:
+            batch = [self.queue.get(block=block)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    # 集めた書き込みを追記1回と更新1回にまとめてコミットする
+    # 同じ回に追記された取引への更新も反映されるよう、追記を先に行う
+    # 戻り値は (Future, 結果) の一覧、失敗した依頼には例外を通知して一覧に含めない
+    def _commit(self, batch):
+        appends = [(payload, future) for kind, payload, future in batch if kind == APPEND]
+        updates = [(payload, future) for kind, payload, future in batch if kind == UPDATE]
+        results = self._commit_group(appends, self._append)
+        results.extend(self._commit_group(updates, self._update))
+        results.extend((future, None) for kind, _, future in batch if kind is None)
+        return results
+
+    # 依頼をまとめて書き込み、失敗したら1件ずつやり直す
+    # 1件の不正な依頼のせいで同じ回の他の依頼まで失敗にしない
+    def _commit_group(self, items, write):
+        if not items:
+            return []
+        try:
+            counts = write([payload for payload, _ in items])
+            return [(future, count) for (_, future), count in zip(items, counts)]
+        except Exception as e:
+            if len(items) == 1:
+                items[0][1].set_exception(e)
+                return []
+        results = []
+        for payload, future in items:
+            try:
+                results.append((future, write([payload])[0]))
+            except Exception as e:
+                future.set_exception(e)
+        return results
+
+    # 追記をまとめて1回で書き込む (結果は依頼ごとの追記件数)
+    def _append(self, payloads):
+        records = [record for payload in payloads for record in payload]
+        if records:
+            self.store.append_many(records)
+        return [len(payload) for payload in payloads]
+
+    # 更新をまとめて1回で書き込む (結果は同じ回にまとめて更新した件数)
+    def _update(self, payloads):
+        updates = {}
+        for payload in payloads:
+            updates.update(payload)
+        updated = self.store.update_statuses(updates) if updates else 0
+        return [updated] * len(payloads)
+
+    # コミット済みの書き込みをfsyncしてから完了を通知する
+    def _sync(self, waiting):
+        try:
+            self.store.sync()
+        except Exception as e:
+            for future, _ in waiting:
+                future.set_exception(e)
+            return
+        for future, result in waiting:
+            future.set_result(result)
+
+    # 届いた書き込みはすぐにコミットし、fsyncはキューが空になったときか
+    # 前回からflush_interval_msたったときにまとめて行う
+    def run(self):
+        waiting = []
+        last_sync = time.monotonic()
+        while True:
+            batch = self._collect(block=not waiting)
+            if batch:
+                waiting.extend(self._commit(batch))
+            now = time.monotonic()
+            if waiting and (self.queue.empty() or now - last_sync >= self.flush_interval):
+                self._sync(waiting)
+                waiting = []
+                last_sync = now
+            if self.stopping and not waiting and self.queue.empty():
+                break
+
+    # 受け付けをやめ、キューに残っている書き込みを済ませてから止める (止まるまで待つ)
+    def stop(self, timeout=30):
+        with self.lock:
+            if self.stopping:
+                return
+            self.stopping = True
+            self.queue.put((None, None, Future()))
+        if self.is_alive():
+            self.join(timeout)
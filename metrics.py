@@ -0,0 +1,363 @@
+import functools
+import os
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 計測のデフォルト設定
+# path はPrometheusのテキスト形式で書き出すファイル (node_exporterのtextfile collector向け)
+# port を指定すると http://host:port/metrics でも返す
+DEFAULT_METRICS = {
+    "enabled": True,
+    "path": "metrics.prom",
+    "interval": 15,
+    "host": "127.0.0.1",
+    "port": None,
+    "profile_interval_ms": 10,
+    "profile_max_stacks": 5000
+}
+
+# ヒストグラムの区切り (秒、0.1ミリ秒から60秒まで)
+DEFAULT_BUCKETS = (
+    0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+    0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 60
+)
+
+# 診断画面に出す分位点
+QUANTILES = (0.5, 0.95, 0.99)
+
+# 待ち状態とみなす末端の関数 (関数名, ファイル名)、プロファイラでは件数だけを数える
+IDLE_FRAMES = {
+    ("wait", "threading.py"),
+    ("select", "selectors.py"),
+    ("readinto", "socket.py"),
+    ("accept", "socket.py"),
+    ("_worker", "thread.py"),
+    ("get", "queue.py"),
+}
+
+
+# 所要時間の分布 (区切りごとの件数だけを持つので、件数が増えてもメモリは増えない)
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # 分位点を区切りの中で線形に補間して求める (Prometheusのhistogram_quantileと同じ考え方)
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+
+# ラベルの値をPrometheusの形式でエスケープする
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in items) + "}"
+
+
+# 所要時間のヒストグラムと回数のカウンターをまとめて持つ (プロセスで1つ)
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    # 所要時間を記録する
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    # 回数を数える
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # withで囲んだ処理の時間を記録する
+    @contextmanager
+    def timer(self, name, **labels):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # 関数の時間を記録するデコレーター
+    def timed(self, name, **labels):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    # Prometheusのテキスト形式にする
+    def render(self):
+        with self.lock:
+            histograms = sorted(
+                (key, list(h.counts), h.count, h.sum) for key, h in self.histograms.items()
+            )
+            counters = sorted(self.counters.items())
+        lines = []
+        declared = set()
+        for (name, labels), counts, count, total in histograms:
+            if name not in declared:
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels, ('le', repr(float(bound))))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels, ('le', '+Inf'))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    # 診断画面向けの一覧 (所要時間はミリ秒)
+    def summary(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            rows = []
+            for (name, labels), histogram in histograms:
+                row = {
+                    "name": name,
+                    "labels": ", ".join(f"{key}={value}" for key, value in labels),
+                    "count": histogram.count,
+                    "mean_ms": histogram.sum / histogram.count * 1000 if histogram.count else None,
+                    "max_ms": histogram.max * 1000
+                }
+                for q in QUANTILES:
+                    row[f"p{int(q * 100)}_ms"] = histogram.quantile(q) * 1000
+                rows.append(row)
+            return rows
+
+    def counter_summary(self):
+        with self.lock:
+            return [
+                {"name": name, "labels": ", ".join(f"{key}={value}" for key, value in labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+
+
+# アプリ全体で使う計測値
+METRICS = MetricsRegistry()
+
+
+# Streamlitの1回の再実行を区切りごとに計測する
+# markを呼ぶたびに前の区切りからの時間をphaseとして記録し、finishで全体の時間を記録する
+class RerunSpan:
+    def __init__(self, registry, name="cashpoint_rerun_phase_seconds"):
+        self.registry = registry
+        self.name = name
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.registry.observe(self.name, now - self.last, phase=phase)
+        self.last = now
+
+    def finish(self):
+        self.registry.observe(self.name, time.perf_counter() - self.started, phase="total")
+
+
+# 計測値を定期的にファイルへ書き出し、portを指定すればHTTPでも返す
+class MetricsExporter(threading.Thread):
+    def __init__(self, registry, path=None, interval=15, host="127.0.0.1", port=None):
+        super().__init__(name="metrics-exporter", daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.server = None
+        if port:
+            exporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def log_message(self, format, *args):
+                    pass
+
+                def do_GET(self):
+                    if self.path != "/metrics":
+                        self.send_error(404)
+                        return
+                    data = exporter.registry.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+
+            self.server = ThreadingHTTPServer((host, port), Handler)
+            self.server.daemon_threads = True
+
+    # 書き出し途中のファイルを読まれないよう、一時ファイルから置き換える
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(self.registry.render())
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def run(self):
+        if self.server is not None:
+            threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+        while not self.stop_event.wait(self.interval):
+            if self.path:
+                try:
+                    self.write()
+                except OSError:
+                    pass
+
+    def stop(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+# 全スレッドのスタックを一定間隔で集める簡易プロファイラ (有効にしたときだけ動く)
+# スタックは関数単位でまとめ、種類がmax_stacksを超えた分は "(other)" に数える
+class SamplingProfiler:
+    def __init__(self, interval_ms=10, max_stacks=5000, max_depth=64):
+        self.interval = interval_ms / 1000
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.samples = 0
+        self.idle = 0
+        self.started_at = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stop_event.clear()
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+            self.idle = 0
+
+    # 1回分のスタックを集める (根元から末端の順、待ち状態のスレッドは数えるだけ)
+    def _sample(self):
+        own = threading.get_ident()
+        stacks = []
+        idle = 0
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            if (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename)) in IDLE_FRAMES:
+                idle += 1
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stacks.append(tuple(reversed(stack)))
+        with self.lock:
+            for stack in stacks:
+                if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                    stack = ("(other)",)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+            self.idle += idle
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._sample()
+
+    # 関数ごとのサンプル数 (selfは末端にいた回数、totalはスタックに含まれていた回数)
+    def top_functions(self, limit=30):
+        with self.lock:
+            stacks = list(self.stacks.items())
+        own = {}
+        total = {}
+        for stack, count in stacks:
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for function in set(stack):
+                total[function] = total.get(function, 0) + count
+        rows = [
+            {"function": function, "self": own.get(function, 0), "total": count}
+            for function, count in total.items()
+        ]
+        rows.sort(key=lambda row: (-row["self"], -row["total"]))
+        return rows[:limit]
+
+    # flamegraph.plやspeedscopeで読める折りたたみ形式
+    def collapsed(self):
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks)
@@ -0,0 +1,290 @@
+import argparse
+import json
+import queue
+import random
+import threading
+import time
+import uuid as uuid_lib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# 代わりのサーバーのデフォルト設定
+# latency はエンドポイントごとの応答時間の分布 (秒)、"default" はそれ以外のエンドポイント
+#   {"dist": "fixed", "value": x} / {"dist": "uniform", "low": a, "high": b} /
+#   {"dist": "lognormal", "median": m, "sigma": s}
+# error_rate はエンドポイントごとにHTTP 503を返す割合
+# transitions は出金後のステータスの移り変わり ([ステータス, 前のステータスからの秒数], ...)
+# failure_rate の割合で最後のステータスを failure_status にする
+DEFAULT_MOCK = {
+    "latency": {
+        "default": {"dist": "fixed", "value": 0}
+    },
+    "error_rate": {
+        "default": 0
+    },
+    "transitions": [["processing", 0], ["Success", 1.0]],
+    "failure_rate": 0,
+    "failure_status": "Payment Error",
+    "cash": {
+        "note": [{"value": 10000, "count": 50}, {"value": 5000, "count": 50}, {"value": 1000, "count": 100}],
+        "coin": [{"value": 500, "count": 100}, {"value": 100, "count": 200}, {"value": 50, "count": 100},
+                 {"value": 10, "count": 200}, {"value": 5, "count": 100}, {"value": 1, "count": 200}]
+    },
+    "seed": None
+}
+
+NO_CHANGE_STATUS = "no change"
+
+
+# 応答時間を分布から選ぶ
+def sample_latency(spec, rng):
+    dist = spec.get("dist", "fixed")
+    if dist == "uniform":
+        return rng.uniform(spec["low"], spec["high"])
+    if dist == "lognormal":
+        return spec["median"] * rng.lognormvariate(0, spec.get("sigma", 0.5))
+    return spec.get("value", 0)
+
+
+# 動作確認と性能測定のためのCash Point APIの代わりのサーバー
+# 出金を受けると設定に従ってステータスを進め、イベントストリーム (SSE) とコールバックで通知する
+class MockCashPoint:
+    def __init__(self, host="127.0.0.1", port=8080, config=None, webhook_url=None, sse=True,
+                 webhook_secret=None):
+        self.config = {**DEFAULT_MOCK, **(config or {})}
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.sse = sse
+        self.rng = random.Random(self.config["seed"])
+        self.lock = threading.Lock()
+        self.transactions = {}
+        self.subscribers = []
+        self.requests = {}
+        self.cash = {
+            kind: [dict(item) for item in self.config["cash"].get(kind, [])] for kind in ("note", "coin")
+        }
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-cashpoint", daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    # エンドポイントごとの設定値を返す
+    def _setting(self, name, path):
+        values = {**DEFAULT_MOCK[name], **self.config[name]}
+        return values.get(path, values["default"])
+
+    # 応答を遅らせ、設定された割合でエラーにするか決める
+    def simulate(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            delay = sample_latency(self._setting("latency", path), self.rng)
+            failed = self.rng.random() < self._setting("error_rate", path)
+        if delay > 0:
+            time.sleep(delay)
+        return failed
+
+    # 在庫から払い出す (大きい金種から、払えなければFalse)
+    def dispense(self, amount):
+        items = sorted(self.cash["note"] + self.cash["coin"], key=lambda item: -item["value"])
+        plan = []
+        rest = amount
+        for item in items:
+            count = min(item["count"], rest // item["value"])
+            plan.append((item, count))
+            rest -= count * item["value"]
+        if rest:
+            return False
+        for item, count in plan:
+            item["count"] -= count
+        return True
+
+    # 出金を受け付ける
+    def refund(self, amount):
+        transaction_id = uuid_lib.uuid4().hex
+        steps = [list(step) for step in self.config["transitions"]]
+        with self.lock:
+            try:
+                payable = self.dispense(int(amount))
+            except (TypeError, ValueError):
+                payable = False
+            if not payable:
+                steps[-1][0] = NO_CHANGE_STATUS
+            elif self.rng.random() < self.config["failure_rate"]:
+                steps[-1][0] = self.config["failure_status"]
+            self.transactions[transaction_id] = {"amount": amount, "status": steps[0][0]}
+        self._schedule(transaction_id, steps[1:])
+        return transaction_id
+
+    # 残りのステータスの移り変わりを予約する
+    def _schedule(self, transaction_id, steps):
+        if not steps:
+            return
+        (status, delay), rest = steps[0], steps[1:]
+
+        def advance():
+            self.set_status(transaction_id, status)
+            self._schedule(transaction_id, rest)
+
+        if delay <= 0:
+            advance()
+            return
+        timer = threading.Timer(delay, advance)
+        timer.daemon = True
+        timer.start()
+
+    # ステータスを変えて通知する
+    def set_status(self, transaction_id, status):
+        with self.lock:
+            self.transactions[transaction_id]["status"] = status
+            subscribers = list(self.subscribers)
+        event = {"uuid": transaction_id, "status": status}
+        for subscriber in subscribers:
+            subscriber.put(event)
+        if self.webhook_url:
+            try:
+                headers = {"X-CashPoint-Secret": self.webhook_secret} if self.webhook_secret else {}
+                requests.post(self.webhook_url, json=event, headers=headers, timeout=3)
+            except requests.exceptions.RequestException:
+                pass
+
+    def status(self, transaction_id):
+        with self.lock:
+            transaction = self.transactions.get(transaction_id)
+            return transaction["status"] if transaction else None
+
+    # GETのエンドポイントの応答データ
+    def info(self, path):
+        with self.lock:
+            if path == "/api/getStatus":
+                processing = sum(
+                    1 for transaction in self.transactions.values() if transaction["status"] == "processing"
+                )
+                return {"status": "busy" if processing else "idle", "processing": processing}
+            if path == "/api/machineInfo":
+                return {"model": "MOCK-1", "serial": "MOCK000001", "firmware": "1.0.0"}
+            if path == "/api/cashInfo":
+                return {kind: [dict(item) for item in items] for kind, items in self.cash.items()}
+            if path == "/api/sensorStatus":
+                return {"door": False, "jam": 0, "temperature": round(self.rng.uniform(30, 40), 1)}
+        return None
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # ヘッダーと本文を別々に書くので、遅延ACKで待たされないようにする
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, body, code=200):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if mock.simulate(self.path):
+                    self._send({"isSuccess": False, "errorMsg": "Service Unavailable"}, 503)
+                elif self.path == "/api/login":
+                    self._send({"isSuccess": True})
+                elif self.path == "/api/refund":
+                    self._send({"isSuccess": True, "data": {"uuid": mock.refund(body.get("amount"))}})
+                elif self.path == "/api/query":
+                    status = mock.status(body.get("uuid"))
+                    if status is None:
+                        self._send({"isSuccess": False, "errorMsg": "取引が見つかりません"})
+                    else:
+                        self._send({"isSuccess": True, "data": {"info": {"status": status}}})
+                elif self.path == "/api/getErrorMessage":
+                    code = body.get("errorCode", "")
+                    self._send({"isSuccess": True, "data": f"エラー {code} (代わりのサーバー)"})
+                else:
+                    self._send({"isSuccess": False, "errorMsg": "not found"}, 404)
+
+            def do_GET(self):
+                if self.path == "/api/events" and mock.sse:
+                    self._stream_events()
+                    return
+                data = mock.info(self.path)
+                if data is None:
+                    self._send({"isSuccess": False, "errorMsg": "not found"}, 404)
+                elif mock.simulate(self.path):
+                    self._send({"isSuccess": False, "errorMsg": "Service Unavailable"}, 503)
+                else:
+                    self._send({"isSuccess": True, "data": data})
+
+            # ステータスの変化をSSEで送り続ける (接続が切れるか停止するまで)
+            def _stream_events(self):
+                subscriber = queue.Queue()
+                with mock.lock:
+                    mock.subscribers.append(subscriber)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                try:
+                    while True:
+                        try:
+                            event = subscriber.get(timeout=10)
+                        except queue.Empty:
+                            self.wfile.write(b": keepalive\n\n")
+                            self.wfile.flush()
+                            continue
+                        if event is None:
+                            break
+                        self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with mock.lock:
+                        mock.subscribers.remove(subscriber)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cash Point APIの代わりのサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--config", default=None, help="設定ファイル (JSON、DEFAULT_MOCKと同じ形式)")
+    parser.add_argument("--webhook", default=None, help="ステータスの変化を送るURL")
+    parser.add_argument("--webhook-secret", default=None, help="コールバックに付ける共有シークレット")
+    parser.add_argument("--no-sse", action="store_true", help="イベントストリームを無効にする")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    mock = MockCashPoint(args.host, args.port, config, args.webhook, not args.no_sse, args.webhook_secret)
+    print(f"{mock.base_url} で待ち受けています")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+from services import (get_cash_info, get_error_message, get_machine_info, get_sensor_status,
+                      get_system_status)
+
+
+# データ取得タブ
+def render(page):
+    machine = page['machine']
+    telemetry_recorder = page['telemetry_recorder']
+
+    st.header("データ取得")
+    
+    data_type = st.selectbox(
+        "取得するデータタイプ",
+        ["エラーメッセージ", "システムステータス", "機器情報", "現金情報", "センサーステータス", "テレメトリ"]
+    )
+    
+    api_url = machine['api_base_url']
+    # 取得した値は機器ごとに持つ
+    api_data = st.session_state.api_data.setdefault(machine['id'], {})
+    
+    if data_type == "エラーメッセージ":
+        st.subheader("エラーメッセージ取得")
+        error_code = st.text_input("エラーコード", placeholder="例: 001001")
+        
+        if st.button("取得", key="error_message_button"):
+            if error_code:
+                if not st.session_state.logged_in:
+                    st.warning("先にメイン画面でログインしてください")
+                else:
+                    success, result = get_error_message(api_url, error_code)
+                    if success:
+                        api_data["error_message"] = result
+                        st.success(f"エラーメッセージ: {result}")
+                    else:
+                        st.error(f"取得失敗: {result}")
+            else:
+                st.warning("エラーコードを入力してください")
+    
+    elif data_type == "システムステータス":
+        st.subheader("システムステータス取得")
+        
+        if st.button("取得", key="system_status_button"):
+            if not st.session_state.logged_in:
+                st.warning("先にメイン画面でログインしてください")
+            else:
+                success, result = get_system_status(api_url)
+                if success:
+                    api_data["system_status"] = result
+                    st.json(result)
+                else:
+                    st.error(f"取得失敗: {result}")
+    
+    elif data_type == "機器情報":
+        st.subheader("機器情報取得")
+        
+        if st.button("取得", key="machine_info_button"):
+            if not st.session_state.logged_in:
+                st.warning("先にメイン画面でログインしてください")
+            else:
+                success, result = get_machine_info(api_url)
+                if success:
+                    api_data["machine_info"] = result
+                    st.json(result)
+                else:
+                    st.error(f"取得失敗: {result}")
+    
+    elif data_type == "現金情報":
+        st.subheader("現金情報取得")
+        
+        if st.button("取得", key="cash_info_button"):
+            if not st.session_state.logged_in:
+                st.warning("先にメイン画面でログインしてください")
+            else:
+                success, result = get_cash_info(api_url)
+                if success:
+                    api_data["cash_info"] = result
+                    st.json(result)
+                else:
+                    st.error(f"取得失敗: {result}")
+    
+    elif data_type == "センサーステータス":
+        st.subheader("センサーステータス取得")
+        
+        if st.button("取得", key="sensor_status_button"):
+            if not st.session_state.logged_in:
+                st.warning("先にメイン画面でログインしてください")
+            else:
+                success, result = get_sensor_status(api_url)
+                if success:
+                    api_data["sensor_status"] = result
+                    st.json(result)
+                else:
+                    st.error(f"取得失敗: {result}")
+
+    elif data_type == "テレメトリ":
+        st.subheader("テレメトリ")
+
+        if telemetry_recorder is None:
+            st.info("テレメトリの記録は無効です (config.json の telemetry.enabled で有効にできます)")
+        else:
+            periods = {"1時間": 1, "6時間": 6, "24時間": 24, "7日間": 24 * 7, "30日間": 24 * 30}
+            period = st.selectbox("期間", list(periods))
+            metric_names = telemetry_recorder.metric_names(machine['id'])
+            metrics = st.multiselect("項目", metric_names, default=metric_names[:5])
+            if telemetry_recorder.last_error:
+                st.caption(f"最後のエラー: {telemetry_recorder.last_error}")
+
+            if metrics:
+                start = (datetime.now() - timedelta(hours=periods[period])).timestamp()
+                series = telemetry_recorder.series(machine['id'], metrics, start)
+                if series.empty:
+                    st.info("記録されたデータがありません")
+                else:
+                    # 線は区間の最後の値、帯は区間内の最小から最大 (間引いても一時的な変化が見える)
+                    import altair as alt
+                    base = alt.Chart(series).encode(
+                        x=alt.X('time:T', title="時刻"),
+                        color=alt.Color('metric:N', title="項目")
+                    )
+                    band = base.mark_area(opacity=0.25).encode(y=alt.Y('min:Q', title="値"), y2='max:Q')
+                    line = base.mark_line().encode(y='last:Q', tooltip=['time:T', 'metric:N', 'min:Q', 'max:Q', 'last:Q'])
+                    st.altair_chart(band + line, width="stretch")
+                    st.caption("線は各区間の最後の値、帯は区間内の最小から最大です")
+            else:
+                st.info("記録されたデータがありません")
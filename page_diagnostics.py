@@ -0,0 +1,87 @@
+import pandas as pd
+import streamlit as st
+
+from metrics import METRICS
+from services import get_metrics_config, open_profiler
+
+
+# 診断タブ (操作ごとの所要時間とプロファイラ)
+def render(page):
+    st.header("診断")
+
+    if not METRICS.enabled:
+        st.warning("計測が無効になっています (設定の metrics.enabled)")
+
+    st.subheader("所要時間")
+    latency = pd.DataFrame(
+        METRICS.summary(),
+        columns=["name", "labels", "count", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    )
+    if latency.empty:
+        st.info("まだ計測値がありません")
+    else:
+        st.dataframe(
+            latency.rename(columns={
+                "name": "名前", "labels": "ラベル", "count": "回数", "mean_ms": "平均 (ms)",
+                "p50_ms": "p50 (ms)", "p95_ms": "p95 (ms)", "p99_ms": "p99 (ms)", "max_ms": "最大 (ms)"
+            }),
+            hide_index=True,
+            use_container_width=True
+        )
+
+    counters = pd.DataFrame(METRICS.counter_summary(), columns=["name", "labels", "value"])
+    if not counters.empty:
+        st.subheader("回数")
+        st.dataframe(
+            counters.rename(columns={"name": "名前", "labels": "ラベル", "value": "回数"}),
+            hide_index=True,
+            use_container_width=True
+        )
+
+    diag_col1, diag_col2 = st.columns(2)
+    with diag_col1:
+        st.download_button(
+            "Prometheus形式でダウンロード",
+            data=METRICS.render(),
+            file_name="metrics.prom",
+            mime="text/plain"
+        )
+    with diag_col2:
+        if st.button("計測値をリセット"):
+            METRICS.reset()
+            st.success("計測値をリセットしました")
+    metrics_config = get_metrics_config()
+    if metrics_config['path']:
+        st.caption(f"{metrics_config['interval']}秒ごとに {metrics_config['path']} へ書き出しています")
+    if metrics_config['port']:
+        st.caption(f"http://{metrics_config['host']}:{metrics_config['port']}/metrics でも取得できます")
+
+    st.subheader("サンプリングプロファイラ")
+    profiler = open_profiler(metrics_config['profile_interval_ms'], metrics_config['profile_max_stacks'])
+    profiling = st.toggle("プロファイラを有効にする", value=profiler.running)
+    if profiling and not profiler.running:
+        profiler.start()
+    elif not profiling and profiler.running:
+        profiler.stop()
+    st.caption(
+        f"{metrics_config['profile_interval_ms']}ミリ秒ごとに全スレッドのスタックを記録します "
+        f"(サンプル数: {profiler.samples}、除外した待ち状態のスタック: {profiler.idle})"
+    )
+    top = pd.DataFrame(profiler.top_functions(), columns=["function", "self", "total"])
+    if not top.empty:
+        st.dataframe(
+            top.rename(columns={"function": "関数", "self": "末端", "total": "合計"}),
+            hide_index=True,
+            use_container_width=True
+        )
+        prof_col1, prof_col2 = st.columns(2)
+        with prof_col1:
+            st.download_button(
+                "スタックをダウンロード (折りたたみ形式)",
+                data=profiler.collapsed(),
+                file_name="profile.folded",
+                mime="text/plain"
+            )
+        with prof_col2:
+            if st.button("サンプルを消去"):
+                profiler.reset()
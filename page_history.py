@@ -0,0 +1,92 @@
+from datetime import timedelta
+from functools import partial
+
+import pandas as pd
+import streamlit as st
+
+from history import EXPORT_FORMATS, build_history_export, history_filter_options, query_history
+from services import (get_archive_config, get_background_reconcile_config, get_history_archive,
+                      get_storage_config, get_store, refresh_history_archive)
+from storage import latest_page, page_count
+
+
+# トランザクション履歴タブ
+def render(page):
+    rerun_span = page['rerun_span']
+
+    st.header("トランザクション履歴")
+    
+    # 締まった月をアーカイブし、絞り込みの選択肢はカタログと直近分から作る
+    storage_config = get_storage_config()
+    archive_config = get_archive_config()
+    refresh_history_archive(
+        storage_config['backend'], storage_config['path'],
+        archive_config['path'], archive_config['row_group_size'],
+        get_background_reconcile_config()['deadline']
+    )
+    store = get_store()
+    archive = get_history_archive()
+    options = history_filter_options(store, archive)
+    
+    if options['min'] is not None:
+        # 日付範囲フィルター (初期表示は直近30日)
+        min_date, max_date = options['min'], options['max']
+        date_range = st.date_input(
+            "日付範囲",
+            value=(max(min_date, max_date - timedelta(days=30)), max_date),
+            min_value=min_date,
+            max_value=max_date
+        )
+        
+        start, end = None, None
+        if len(date_range) == 2:
+            start_date, end_date = date_range
+            start = pd.Timestamp(start_date)
+            end = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+        
+        # 応対者名でフィルター
+        users = ['すべて'] + options['operators']
+        selected_user = st.selectbox("応対者名でフィルター", users)
+        
+        # ステータスでフィルター
+        statuses = ['すべて'] + options['statuses']
+        selected_status = st.selectbox("ステータスでフィルター", statuses)
+        
+        # 機器でフィルター (複数の機器の取引があるときのみ)
+        selected_machine = 'すべて'
+        if len(options['machines']) > 1:
+            selected_machine = st.selectbox("機器でフィルター", ['すべて'] + options['machines'])
+        
+        # 条件はアーカイブとストレージの読み込み時に適用する
+        operators = None if selected_user == 'すべて' else [selected_user]
+        selected_statuses = None if selected_status == 'すべて' else [selected_status]
+        selected_machines = None if selected_machine == 'すべて' else [selected_machine]
+        filtered_df = query_history(
+            store, archive, start, end, operators, selected_statuses, selected_machines
+        )
+        rerun_span.mark("トランザクション履歴:検索")
+        
+        # データ表示 (表示するページ分だけを選んで送る)
+        page_col1, page_col2 = st.columns(2)
+        with page_col1:
+            page_size = st.selectbox("表示件数", [25, 50, 100, 200], index=1)
+        pages = page_count(len(filtered_df), page_size)
+        with page_col2:
+            page = st.number_input("ページ", min_value=1, max_value=pages, value=1, step=1)
+        st.caption(f"全{len(filtered_df)}件 ({page}/{pages}ページ)")
+        st.dataframe(latest_page(filtered_df, page=page - 1, page_size=page_size), use_container_width=True)
+        
+        # ダウンロードボタン (押されたときだけ作る、圧縮形式なら配信のために持つデータも小さい)
+        export_format = st.selectbox("ダウンロード形式", list(EXPORT_FORMATS))
+        _, _, suffix, mime = EXPORT_FORMATS[export_format]
+        st.download_button(
+            label="ダウンロード",
+            data=partial(
+                build_history_export, store, archive, start, end,
+                operators, selected_statuses, selected_machines, export_format
+            ),
+            file_name=f"transaction_history{suffix}",
+            mime=mime,
+        )
+    else:
+        st.info("取引データがありません")
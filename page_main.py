@@ -0,0 +1,300 @@
+from functools import partial
+
+import streamlit as st
+
+from fleet import fan_out
+from reconcile import reconcile_statuses
+from services import (ACCOUNT_ITEMS, api_login, check_transaction_status, execute_withdrawal,
+                      get_batch_config, get_change_inventory, get_client, get_client_health, get_journal,
+                      get_reconcile_config, get_store, invalidate_history_archive, load_transactions,
+                      open_batch_jobs, open_batch_ledger, open_rate_limiter, save_config,
+                      save_transaction)
+
+
+# 一括出金の進み具合 (実行中はこの部分だけを1秒ごとに描き直し、終わったら画面全体を再実行して結果を出す)
+@st.fragment(run_every=1)
+def show_batch_progress(job):
+    if not job.is_alive():
+        st.rerun()
+    st.progress(job.done / job.total, text=f"出金中 ({job.done}/{job.total})")
+    st.caption("一括出金はバックグラウンドで続きます。画面を操作しても中断されません")
+
+
+# 一括出金の結果
+def show_batch_result(job):
+    if job.error:
+        st.error(f"一括出金が途中で止まりました ({job.done}/{job.total}件処理済み): {job.error}")
+    if job.results is not None and not job.results.empty:
+        counts = job.results['結果'].value_counts()
+        st.success(" / ".join(f"{label}: {count}件" for label, count in counts.items()))
+        if counts.get("実行済み"):
+            st.warning(
+                f"{counts['実行済み']}件は同じバッチ名で出金済みのため出金していません (メッセージ欄を確認してください)"
+            )
+        st.dataframe(job.results, hide_index=True)
+
+
+# メイン画面タブ (設定・ログイン・出金・最近の取引)
+def render(page):
+    machine = page['machine']
+    machines = page['machines']
+    config = page['config']
+    status_events = page['status_events']
+
+    # 2カラムレイアウト
+    col1, col2 = st.columns(2)
+
+    # 設定パネル (左カラム)
+    with col1:
+        st.header("API設定")
+        
+        api_url = st.text_input("API URL", value=machine['api_base_url'], placeholder="http://127.0.0.1:8080")
+        username = st.text_input("ユーザー名", value=machine['auth']['username'], placeholder="admin")
+        password = st.text_input("パスワード", value=machine['auth']['password'], type="password")
+        
+        col1_1, col1_2 = st.columns(2)
+        with col1_1:
+            if st.button("設定保存", type="primary"):
+                new_settings = {
+                    "api_base_url": api_url,
+                    "auth": {
+                        "username": username,
+                        "password": password
+                    }
+                }
+                # 複数台構成なら選択中の機器の設定だけを更新する
+                if config.get('machines'):
+                    new_config = {
+                        **config,
+                        "machines": [
+                            {**m, **new_settings} if m['id'] == machine['id'] else m
+                            for m in config['machines']
+                        ]
+                    }
+                else:
+                    new_config = {**config, **new_settings}
+                save_config(new_config)
+                st.success("設定を保存しました")
+        
+        with col1_2:
+            if st.button("ログイン"):
+                success, message = api_login(api_url, username, password)
+                if success:
+                    st.session_state.machine_logins[machine['id']] = True
+                    st.session_state.logged_in = True
+                    st.success(message)
+                else:
+                    st.error(message)
+        
+        # 全機器へ並列にログイン (複数台構成のときのみ)
+        if len(machines) > 1 and st.button("全機器にログイン"):
+            logins = fan_out(
+                machines,
+                lambda m: api_login(m['api_base_url'], m['auth']['username'], m['auth']['password'])
+            )
+            for m in machines:
+                entry = logins[m['id']]
+                success, message = entry['result'] or (False, entry['error'])
+                if success:
+                    st.session_state.machine_logins[m['id']] = True
+                    st.success(f"{m['name']}: {message}")
+                else:
+                    st.error(f"{m['name']}: {message}")
+            st.session_state.logged_in = st.session_state.machine_logins.get(machine['id'], False)
+
+    # 出金パネル (右カラム)
+    with col2:
+        st.header("出金操作")
+        
+        user_name = st.text_input("応対者名", placeholder="山田太郎")
+        payee = st.text_input("お支払先", placeholder="株式会社〇〇")
+        account_item = st.selectbox("勘定項目", options=ACCOUNT_ITEMS)
+        amount = st.text_input("出金金額", placeholder="1000")
+        
+        # ステータス通知の状態 (つながっていなければ照会で確認する)
+        if status_events is not None:
+            if status_events.is_active():
+                st.caption("ステータス通知: 受信中")
+            else:
+                # 設定の誤りなどで受信できないときは理由も出す
+                errors = [c['error'] for c in status_events.health()['channels'].values() if c['error']]
+                detail = f": {errors[0]}" if errors else ""
+                st.caption(f"ステータス通知: 未接続 (照会で確認しています{detail})")
+
+        # 機器への接続状態 (遮断中は出金できないようにする、通信せずに確認できる)
+        health = get_client_health(api_url)
+        if not health['available']:
+            st.warning(f"機器に接続できないため出金を停止しています。復旧を確認中です ({health['last_error']})")
+
+        col2_1, col2_2 = st.columns(2)
+        with col2_1:
+            withdraw_button = st.button(
+                "出金実行", disabled=not st.session_state.logged_in or not health['available']
+            )
+            if withdraw_button:
+                # 入力チェック
+                if not user_name:
+                    st.error("応対者名を入力してください")
+                elif not payee:
+                    st.error("お支払先を入力してください")
+                else:
+                    try:
+                        amount_val = int(amount)
+                        if amount_val <= 0:
+                            st.error("出金金額は0より大きい値を入力してください")
+                        else:
+                            # 釣銭の在庫で払い出せるかを先に確認 (払えれば処理中の分として在庫から差し引く)
+                            change_inventory = get_change_inventory(api_url)
+                            if change_inventory is not None:
+                                payable, reservation, change_message = change_inventory.reserve(amount_val)
+                            else:
+                                payable, reservation, change_message = True, None, ""
+
+                            if not payable:
+                                st.error(change_message)
+                            else:
+                                # 出金処理実行 (このときだけAPIクライアントのモジュールを読み込む)
+                                from cashpoint_client import is_unknown_result
+                                success, uuid, message = execute_withdrawal(api_url, amount)
+                                if success and uuid:
+                                    # トランザクション保存
+                                    save_transaction(
+                                        user_name,
+                                        payee,
+                                        account_item,
+                                        amount,
+                                        uuid,
+                                        "出金処理中",
+                                        machine['id']
+                                    )
+                                    st.success(message)
+                                elif is_unknown_result(message):
+                                    # 機器で払い出された可能性があるので、在庫の確保は戻さずに要確認として記録する
+                                    # (出金実行をもう一度押すと二重に払い出されるおそれがある)
+                                    save_transaction(
+                                        user_name,
+                                        payee,
+                                        account_item,
+                                        amount,
+                                        None,
+                                        "要確認",
+                                        machine['id']
+                                    )
+                                    st.error(message)
+                                    st.warning("この出金は要確認として記録しました。機器の出金履歴を確認するまで再実行しないでください")
+                                else:
+                                    if change_inventory is not None:
+                                        change_inventory.release(reservation)
+                                    st.error(message)
+                    except ValueError:
+                        st.error("出金金額は数値を入力してください")
+        
+        with col2_2:
+            if st.button("データ更新"):
+                # 全機器の未完了のトランザクションのステータスを並列に照会
+                pending = {
+                    uuid: pending_machine_id
+                    for uuid, _, pending_machine_id in get_store().pending_transactions()
+                }
+                machine_urls = {m['id']: m['api_base_url'] for m in machines}
+                progress = st.progress(0.0, text=f"ステータス照会中 (0/{len(pending)})")
+                result = reconcile_statuses(
+                    lambda uuid, pending_machine_id: check_transaction_status(
+                        machine_urls.get(pending_machine_id, machine['api_base_url']), uuid
+                    ),
+                    pending,
+                    max_workers=get_reconcile_config()['max_workers'],
+                    on_progress=lambda done, total: progress.progress(
+                        done / total, text=f"ステータス照会中 ({done}/{total})"
+                    )
+                )
+                progress.empty()
+                
+                # 変更はまとめて1回で書き込む
+                if result.updates:
+                    get_journal().update_statuses(result.updates)
+                    invalidate_history_archive()
+                    st.success("トランザクションステータスを更新しました")
+                if result.failures:
+                    st.warning(f"{len(result.failures)}件のステータス照会に失敗しました")
+                    with st.expander("照会に失敗したトランザクション"):
+                        for uuid, message in result.failures.items():
+                            st.write(f"{uuid}: {message}")
+
+        # 一括出金 (CSVの各行をバックグラウンドで順に出金し、出金できた行はその場で保存する)
+        with st.expander("一括出金 (CSV)"):
+            st.caption(f"列: 応対者名, お支払先, 勘定項目, 出金金額 / 勘定項目: {', '.join(ACCOUNT_ITEMS)}")
+            batch_jobs = open_batch_jobs()
+            batch_job = batch_jobs.get(machine['id'])
+            batch_running = batch_job is not None and batch_job.is_alive()
+            batch_file = st.file_uploader("出金データ", type=["csv"])
+            if batch_file is not None:
+                from batch import batch_keys, done_entries, run_batch, validate_batch
+                batch_config = get_batch_config()
+                batch_ledger = open_batch_ledger(batch_config['ledger_path'], batch_config['ledger_ttl_days'])
+                batch_rows, batch_errors = validate_batch(batch_file.getvalue(), ACCOUNT_ITEMS)
+                # 同じバッチ名で同じ内容の行は出金済みとして扱う (台帳の記録は ledger_ttl_days 日で期限切れ)
+                batch_name = st.text_input(
+                    "バッチ名", value=batch_file.name,
+                    help=(
+                        f"同じバッチ名で内容が同じ行は、ファイルを直して再実行しても"
+                        f"{batch_config['ledger_ttl_days']}日間は二重に出金しません。"
+                        "別の出金として実行するときはバッチ名を変えてください"
+                    )
+                )
+                row_keys = batch_keys(batch_name, batch_rows)
+                st.write(f"実行できる行: {len(batch_rows)}件 / 合計 {int(batch_rows['出金金額'].sum()):,}円")
+                if not batch_errors.empty:
+                    st.warning(f"{len(batch_errors)}件の入力エラーがあります (エラーの行は実行されません)")
+                    st.dataframe(batch_errors, hide_index=True)
+                # 出金済みの行は実行してもスキップされるので、実行前に知らせる
+                done = done_entries(batch_ledger, row_keys)
+                if done:
+                    last_at = max(entry['at'] for entry in done.values())
+                    st.warning(
+                        f"{len(done)}件はバッチ名「{batch_name}」で出金済み (最終 {last_at}) のため、"
+                        "実行しても出金されません。別の出金として実行するときはバッチ名を変えてください"
+                    )
+
+                if st.button(
+                    "一括出金実行",
+                    disabled=(not st.session_state.logged_in or batch_rows.empty
+                              or not health['available'] or batch_running)
+                ):
+                    # 共有のリソースはここで開いてからスレッドに渡す (スレッドからはキャッシュを使わない)
+                    run = partial(
+                        run_batch,
+                        batch_rows,
+                        row_keys,
+                        get_client(api_url).refund,
+                        batch_ledger,
+                        open_rate_limiter(api_url, batch_config['rate_per_minute']),
+                        machine['id'],
+                        get_journal().append,
+                        existing_uuids=get_store().existing_uuids,
+                        inventory=get_change_inventory(api_url)
+                    )
+                    # 別の画面で同じ機器の一括出金が始まっていれば、そちらの進み具合を表示する
+                    batch_jobs.start(
+                        machine['id'], len(batch_rows), lambda on_progress: run(on_progress=on_progress)
+                    )
+                    batch_job = batch_jobs.get(machine['id'])
+                    batch_running = batch_job.is_alive()
+
+            # 実行中なら進み具合、終わっていれば最後の結果を表示する
+            if batch_running:
+                show_batch_progress(batch_job)
+            elif batch_job is not None:
+                show_batch_result(batch_job)
+
+    # トランザクション一覧 (pandasを使うので入力欄を表示したあとで読み込む)
+    from storage import latest_page
+    st.header("最近の取引")
+    df = load_transactions()
+    if not df.empty:
+        st.dataframe(
+            latest_page(df, page=0, page_size=10),
+            use_container_width=True
+        )
+    else:
+        st.info("取引データがありません")
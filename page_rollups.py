@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+from services import get_store
+from storage import ROLLUP_COLUMNS, ROLLUP_DIMENSIONS, ROLLUP_LABELS
+
+
+# 支出集計タブ (日別集計から読むため、期間が長くても取引の件数によらない)
+def render(page):
+    st.header("支出集計")
+
+    today = datetime.now().date()
+    date_range = st.date_input("期間", value=(today.replace(day=1), today))
+    dimension = st.selectbox("集計する項目", ROLLUP_DIMENSIONS)
+
+    if len(date_range) == 2:
+        rollups = get_store().daily_rollups(date_range[0], date_range[1] + timedelta(days=1), dimension)
+        if rollups.empty:
+            st.info("該当する取引がありません")
+        else:
+            totals = rollups.groupby('value')[ROLLUP_COLUMNS].sum().sort_values('amount', ascending=False)
+            col1, col2, col3 = st.columns(3)
+            col1.metric("件数", f"{int(totals['count'].sum()):,}件")
+            col2.metric("出金金額", f"{int(totals['amount'].sum()):,}円")
+            col3.metric("完了金額", f"{int(totals['completed_amount'].sum()):,}円")
+
+            st.subheader(f"{dimension}別")
+            st.dataframe(totals.rename(columns=ROLLUP_LABELS).rename_axis(dimension), use_container_width=True)
+
+            st.subheader("日別の出金金額")
+            daily = rollups.pivot_table(index='day', columns='value', values='amount', aggfunc='sum', fill_value=0)
+            st.bar_chart(daily)
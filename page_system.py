@@ -0,0 +1,79 @@
+import pandas as pd
+import streamlit as st
+
+from fleet import fan_out, fleet_cash_table, fleet_summary
+from services import get_device_cache
+
+
+# システム情報タブ
+def render(page):
+    machine = page['machine']
+    machines = page['machines']
+
+    st.header("システム情報")
+    
+    if not st.session_state.logged_in:
+        st.warning("先にメイン画面でログインしてください")
+    else:
+        refresh_button = st.button("情報を更新")
+        
+        # 全機器の4項目を並列に取得 (更新ボタン以外では期限切れでも前回の値をすぐ表示し、裏で更新する)
+        names = ["system_status", "machine_info", "cash_info", "sensor_status"]
+        device_caches = {m['id']: get_device_cache(m['api_base_url']) for m in machines}
+        snapshot = fan_out(
+            machines,
+            lambda m: device_caches[m['id']].get_many(names, force=refresh_button)
+        )
+        
+        # 複数台構成なら全機器の一覧と在庫をまとめて表示
+        if len(machines) > 1:
+            st.subheader("フリート一覧")
+            st.dataframe(fleet_summary(machines, snapshot), use_container_width=True)
+            for kind, label in [("note", "紙幣在庫 (全機器)"), ("coin", "硬貨在庫 (全機器)")]:
+                cash_table = fleet_cash_table(machines, snapshot, kind)
+                if not cash_table.empty:
+                    st.write(f"{label}:")
+                    st.dataframe(cash_table, use_container_width=True)
+            st.subheader(f"{machine['name']} の詳細")
+        
+        # 取得した値は機器ごとに持つ (機器を切り替えて取得に失敗したときに前の機器の値を出さない)
+        api_data = st.session_state.api_data.setdefault(machine['id'], {})
+        entry = snapshot[machine['id']]
+        if entry['error']:
+            st.error(f"取得失敗: {entry['error']}")
+        for name, (success, result) in (entry['result'] or {}).items():
+            if success:
+                api_data[name] = result
+            else:
+                st.error(f"取得失敗: {result}")
+        
+        # システムステータスの表示
+        if "system_status" in api_data:
+            st.subheader("システムステータス")
+            st.json(api_data["system_status"])
+        
+        # 機器情報の表示
+        if "machine_info" in api_data:
+            st.subheader("機器情報")
+            st.json(api_data["machine_info"])
+        
+        # 現金情報の表示
+        if "cash_info" in api_data:
+            st.subheader("現金情報")
+            
+            # 紙幣情報
+            if "note" in api_data["cash_info"]:
+                st.write("紙幣情報:")
+                note_df = pd.DataFrame(api_data["cash_info"]["note"])
+                st.dataframe(note_df)
+            
+            # 硬貨情報
+            if "coin" in api_data["cash_info"]:
+                st.write("硬貨情報:")
+                coin_df = pd.DataFrame(api_data["cash_info"]["coin"])
+                st.dataframe(coin_df)
+        
+        # センサーステータスの表示
+        if "sensor_status" in api_data:
+            st.subheader("センサーステータス")
+            st.json(api_data["sensor_status"])
@@ -0,0 +1,168 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+# 機器のステータスとアプリのステータスの対応
+COMPLETED_STATUSES = ["payment is completed", "Success"]
+FAILED_STATUSES = ["Payment Error", "user cancelled", "no change"]
+
+
+# 機器のステータスをアプリのステータスに変換する (未確定ならNone)
+def map_device_status(status):
+    if status in COMPLETED_STATUSES:
+        return "完了"
+    elif status in FAILED_STATUSES:
+        return "失敗"
+    return None
+
+
+# 照合結果
+class ReconcileResult:
+    def __init__(self):
+        self.updates = {}
+        self.failures = {}
+        self.checked = 0
+
+
+# 未完了のトランザクションを並列に照会してステータスの変更をまとめる
+# pendingは {UUID: 機器ID}、check_statusは (UUID, 機器ID) を受け取る
+def reconcile_statuses(check_status, pending, max_workers=8, on_progress=None):
+    result = ReconcileResult()
+    if not pending:
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(check_status, uuid, machine_id): uuid
+            for uuid, machine_id in pending.items()
+        }
+        for future in as_completed(futures):
+            uuid = futures[future]
+            try:
+                success, status = future.result()
+            except Exception as e:
+                success, status = False, str(e)
+
+            if success:
+                new_status = map_device_status(status)
+                if new_status:
+                    result.updates[uuid] = new_status
+            else:
+                result.failures[uuid] = status
+
+            result.checked += 1
+            if on_progress:
+                on_progress(result.checked, len(pending))
+    return result
+
+
+# バックグラウンド照合のデフォルト設定
+DEFAULT_BACKGROUND_RECONCILE = {
+    "enabled": False,
+    "initial_interval": 2,
+    "max_interval": 60,
+    "backoff_factor": 2,
+    "deadline": 3600,
+    "rescan_interval": 5,
+    "max_workers": 4
+}
+
+
+# 出金処理中のトランザクションを定期的に照会するワーカー
+# 照会間隔は取引ごとに経過時間に応じて伸ばし、期限を過ぎたら照会をやめる
+# writerを渡すとステータスの更新はそちらに書き込む (省略時はstoreに直接書き込む)
+# push_activeがTrueを返す間はステータス通知が届くので、取りこぼしに備えてmax_intervalごとにだけ照会する
+class ReconcileWorker(threading.Thread):
+    def __init__(self, store, check_status, initial_interval=2, max_interval=60,
+                 backoff_factor=2, deadline=3600, rescan_interval=5, max_workers=4, writer=None,
+                 push_active=None):
+        super().__init__(name="reconcile-worker", daemon=True)
+        self.store = store
+        self.writer = writer or store
+        self.push_active = push_active
+        self.check_status = check_status
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.deadline = deadline
+        self.rescan_interval = rescan_interval
+        self.max_workers = max_workers
+        self.stop_event = threading.Event()
+        self.schedule = {}
+        self.given_up = set()
+        self.last_error = None
+
+    # 照会回数に応じた次回までの間隔を計算する
+    def interval(self, attempts):
+        if self.push_active and self.push_active():
+            return self.max_interval
+        return min(self.max_interval, self.initial_interval * self.backoff_factor ** attempts)
+
+    # 取引の経過秒数を計算する
+    def age(self, created_at, now):
+        try:
+            created = datetime.strptime(str(created_at), '%Y-%m-%d %H:%M:%S').timestamp()
+        except ValueError:
+            return 0
+        return now - created
+
+    # 照会対象の一覧を更新する
+    def rescan(self, now):
+        pending = {uuid: (created_at, machine_id)
+                   for uuid, created_at, machine_id in self.store.pending_transactions()}
+        for uuid in list(self.schedule):
+            if uuid not in pending:
+                del self.schedule[uuid]
+        for uuid, (created_at, machine_id) in pending.items():
+            if uuid in self.given_up or uuid in self.schedule:
+                continue
+            if self.age(created_at, now) > self.deadline:
+                self.given_up.add(uuid)
+                continue
+            # [次回照会時刻, 照会回数, 登録日時, 機器ID]
+            first_poll = now + self.max_interval if self.push_active and self.push_active() else now
+            self.schedule[uuid] = [first_poll, 0, created_at, machine_id]
+
+    # 期限が来た取引をまとめて照会し、変更を書き込む
+    def poll_due(self, now):
+        due = {uuid: entry[3] for uuid, entry in self.schedule.items() if entry[0] <= now}
+        if not due:
+            return
+        result = reconcile_statuses(self.check_status, due, max_workers=self.max_workers)
+        if result.updates:
+            self.writer.update_statuses(result.updates)
+        for uuid in due:
+            if uuid in result.updates:
+                del self.schedule[uuid]
+                continue
+            entry = self.schedule[uuid]
+            entry[1] += 1
+            entry[0] = now + self.interval(entry[1])
+            if self.age(entry[2], entry[0]) > self.deadline:
+                del self.schedule[uuid]
+                self.given_up.add(uuid)
+
+    def run(self):
+        last_scan = 0
+        push_was_active = False
+        while not self.stop_event.is_set():
+            now = time.time()
+            try:
+                # ステータス通知が途切れたら、すぐに通常の照会に戻す
+                push_active = bool(self.push_active and self.push_active())
+                if push_was_active and not push_active:
+                    for entry in self.schedule.values():
+                        entry[0] = min(entry[0], now)
+                push_was_active = push_active
+                if now - last_scan >= self.rescan_interval:
+                    self.rescan(now)
+                    last_scan = now
+                self.poll_due(now)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+            self.stop_event.wait(1)
+
+    def stop(self):
+        self.stop_event.set()
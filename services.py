@@ -0,0 +1,490 @@
+import os
+import threading
+from datetime import datetime
+
+import streamlit as st
+
+from change import DEFAULT_CHANGE_CHECK, ChangeInventory
+from config_file import DEFAULT_MACHINE_ID, ConfigFile
+from device_cache import DEFAULT_DEVICE_CACHE, DeviceInfoCache
+from error_cache import DEFAULT_ERROR_CACHE, ErrorMessageCache, error_cache_path
+from journal import DEFAULT_JOURNAL, TransactionJournal
+from metrics import DEFAULT_METRICS, METRICS, MetricsExporter, SamplingProfiler
+from reconcile import DEFAULT_BACKGROUND_RECONCILE, ReconcileWorker
+
+# 画面から使う設定・共有リソース・API呼び出し
+# pandas・pyarrow・numpy・requestsを使うモジュールは、使う関数の中で読み込む
+# (起動直後の再実行でメイン画面の入力欄を先に表示し、使わない機能の読み込みを省くため)
+
+# 設定ファイルのパス
+CONFIG_FILE = "config.json"
+TRANSACTION_FILE = "transactions.csv"
+TRANSACTION_DB = "transactions.db"
+
+# ステータス照合のデフォルト設定
+DEFAULT_RECONCILE = {
+    "max_workers": 8
+}
+
+# 勘定項目
+ACCOUNT_ITEMS = ['会議費', '交通費', '接待費', '消耗品費', 'その他']
+
+# ストレージのデフォルト設定
+DEFAULT_STORAGE = {
+    "backend": "sqlite",
+    "path": TRANSACTION_DB
+}
+
+# 設定ファイル (プロセスで1つ、ファイルが変わったときだけ読み直す)
+CONFIG = ConfigFile(CONFIG_FILE, default={
+    "api_base_url": "http://127.0.0.1:8080",
+    "auth": {
+        "username": "admin",
+        "password": "0000"
+    }
+})
+
+# 初期設定の確認と作成 (セッションごとに1回だけ確認する)
+def ensure_config():
+    if st.session_state.get('config_checked'):
+        return
+    if not CONFIG.exists():
+        from batch import DEFAULT_BATCH
+        from cashpoint_client import DEFAULT_HTTP
+        from history import DEFAULT_ARCHIVE
+        from status_events import DEFAULT_STATUS_EVENTS
+        from telemetry import DEFAULT_TELEMETRY
+        default_config = {
+            "api_base_url": "http://127.0.0.1:8080",
+            "auth": {
+                "username": "admin",
+                "password": "0000"
+            },
+            "storage": DEFAULT_STORAGE,
+            "http": DEFAULT_HTTP,
+            "reconcile": DEFAULT_RECONCILE,
+            "background_reconcile": DEFAULT_BACKGROUND_RECONCILE,
+            "archive": DEFAULT_ARCHIVE,
+            "error_cache": DEFAULT_ERROR_CACHE,
+            "device_cache": DEFAULT_DEVICE_CACHE,
+            "telemetry": DEFAULT_TELEMETRY,
+            "change_check": DEFAULT_CHANGE_CHECK,
+            "batch": DEFAULT_BATCH,
+            "journal": DEFAULT_JOURNAL,
+            "status_events": DEFAULT_STATUS_EVENTS,
+            "metrics": DEFAULT_METRICS
+        }
+        CONFIG.save(default_config)
+        st.success("デフォルト設定ファイルを作成しました")
+
+    storage_config = get_storage_config()
+    if not os.path.exists(storage_config['path']):
+        get_store()
+        st.success("トランザクションファイルを作成しました")
+    st.session_state.config_checked = True
+
+# 設定を読み込む (共有の辞書なので書き換えないこと)
+def load_config():
+    return CONFIG.load()
+
+# 設定を保存する
+def save_config(config):
+    CONFIG.save(config)
+
+# ストレージ設定を取得する
+def get_storage_config():
+    return {**DEFAULT_STORAGE, **load_config().get('storage', {})}
+
+# ステータス照合の設定を取得する
+def get_reconcile_config():
+    return {**DEFAULT_RECONCILE, **load_config().get('reconcile', {})}
+
+# バックグラウンド照合の設定を取得する
+def get_background_reconcile_config():
+    return {**DEFAULT_BACKGROUND_RECONCILE, **load_config().get('background_reconcile', {})}
+
+# ストレージを開く (全セッションで共有)
+@st.cache_resource
+def open_transaction_store(backend, path):
+    from storage import migrate_csv_to_sqlite, open_store
+    # 新規のSQLiteには既存のCSVを一度だけ取り込む
+    if backend == "sqlite" and not os.path.exists(path) and os.path.exists(TRANSACTION_FILE):
+        migrate_csv_to_sqlite(TRANSACTION_FILE, path)
+    return open_store(backend, path)
+
+def get_store():
+    storage_config = get_storage_config()
+    return open_transaction_store(storage_config['backend'], storage_config['path'])
+
+# 書き込みジャーナル (全セッションの書き込みを1つのスレッドでまとめてコミットする、プロセスで1つだけ)
+# 設定が変わったら前のジャーナルの残りの書き込みを済ませて止めてから起動し直すので、書き込むスレッドは常に1つ
+# ジャーナルを使うバックグラウンドの処理は、ジャーナルが替わったら起動し直す (設定のキーにジャーナルを含める)
+def get_journal():
+    storage_config = get_storage_config()
+    journal_config = {**DEFAULT_JOURNAL, **load_config().get('journal', {})}
+
+    def start():
+        journal = TransactionJournal(
+            open_transaction_store(storage_config['backend'], storage_config['path']),
+            **journal_config
+        )
+        journal.start()
+        return journal
+
+    return open_background_services().ensure("journal", (storage_config, journal_config), start)
+
+# トランザクションのキャッシュを開く (全セッションで共有)
+@st.cache_resource
+def open_transaction_loader(backend, path):
+    from storage import CachedTransactionLoader
+    return CachedTransactionLoader(open_transaction_store(backend, path))
+
+# トランザクションを読み込む (変更がなければキャッシュを返す)
+def load_transactions():
+    storage_config = get_storage_config()
+    return open_transaction_loader(storage_config['backend'], storage_config['path']).load()
+
+# トランザクションを保存する
+def save_transaction(user_name, payee, account_item, amount, uuid, status, machine_id=DEFAULT_MACHINE_ID):
+    new_row = {
+        '日時': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        '応対者名': user_name,
+        'お支払先': payee,
+        '勘定項目': account_item,
+        '出金金額': amount,
+        'UUID': uuid,
+        'ステータス': status,
+        '機器ID': machine_id
+    }
+    get_journal().append(new_row)
+    return new_row
+
+# 開いたAPIクライアントの一覧 (機器のURLごとに最後に開いたもの)
+@st.cache_resource
+def open_client_registry():
+    return {}
+
+# APIクライアントを開く (全セッションで共有)
+@st.cache_resource
+def open_cashpoint_client(base_url, **http_config):
+    from cashpoint_client import CashPointClient
+    client = CashPointClient(base_url, **http_config)
+    open_client_registry()[base_url] = client
+    return client
+
+def get_http_config():
+    from cashpoint_client import DEFAULT_HTTP
+    return {**DEFAULT_HTTP, **load_config().get('http', {})}
+
+def get_client(base_url):
+    return open_cashpoint_client(base_url, **get_http_config())
+
+# 機器への接続状態 (通信せずに遮断器の状態を返す)
+# まだクライアントを開いていなければ失敗も起きていないので、requestsを読み込まずに接続可とする
+def get_client_health(base_url):
+    client = open_client_registry().get(base_url)
+    if client is None:
+        return {"available": True, "state": "closed", "failures": 0, "last_error": None}
+    return client.health()
+
+# 取引履歴のアーカイブを開く (全セッションで共有)
+@st.cache_resource
+def open_history_archive(path, row_group_size):
+    from history import HistoryArchive
+    return HistoryArchive(path, row_group_size)
+
+def get_archive_config():
+    from history import DEFAULT_ARCHIVE
+    return {**DEFAULT_ARCHIVE, **load_config().get('archive', {})}
+
+def get_history_archive():
+    archive_config = get_archive_config()
+    return open_history_archive(archive_config['path'], archive_config['row_group_size'])
+
+# 締まった月をアーカイブに書き出す (1時間に1回まで)
+# 照合の期限を過ぎた未完了の取引は月を締めるのを止めない
+@st.cache_data(ttl=3600, show_spinner=False)
+def refresh_history_archive(backend, path, archive_path, row_group_size, pending_deadline):
+    from history import archive_closed_months
+    return archive_closed_months(
+        open_transaction_store(backend, path),
+        open_history_archive(archive_path, row_group_size),
+        pending_deadline=pending_deadline
+    )
+
+# ステータスを更新したら次に履歴を開いたときにアーカイブを確認し直す
+# (期限を過ぎてアーカイブ済みの取引が更新されていれば、その月だけ書き直される)
+def invalidate_history_archive():
+    refresh_history_archive.clear()
+
+# 機器情報のキャッシュ (機器ごとにプロセスで1つ、全セッションで共有)
+# 設定やクライアントが変わったら前のキャッシュの問い合わせスレッドを止めてから作り直す
+def get_device_cache(base_url):
+    device_cache_config = {**DEFAULT_DEVICE_CACHE, **load_config().get('device_cache', {})}
+    client = get_client(base_url)
+
+    def start():
+        return DeviceInfoCache(
+            {
+                "system_status": client.system_status,
+                "machine_info": client.machine_info,
+                "cash_info": client.cash_info,
+                "sensor_status": client.sensor_status
+            },
+            **device_cache_config
+        )
+
+    return open_background_services().ensure(
+        f"device_cache:{base_url}", (device_cache_config, client), start
+    )
+
+# 設定で動かすバックグラウンドの処理 (名前ごとにプロセスで1つだけ動かす)
+# 設定が変わったら前のものを止めてから起動し直すので、古い設定のものが残らない
+class BackgroundServices:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+
+    # 設定が同じなら動いているものを返し、変わっていれば止めてから start() で起動し直す
+    def ensure(self, name, settings, start):
+        with self.lock:
+            current = self.running.get(name)
+            if current is not None and current[0] == settings:
+                return current[1]
+            if current is not None:
+                del self.running[name]
+                current[1].stop()
+            service = start()
+            self.running[name] = (settings, service)
+            return service
+
+    # 無効にされたものを止める
+    def stop(self, name):
+        with self.lock:
+            current = self.running.pop(name, None)
+        if current is not None:
+            current[1].stop()
+
+    def get(self, name):
+        with self.lock:
+            current = self.running.get(name)
+            return current[1] if current is not None else None
+
+# バックグラウンドの処理の一覧 (プロセスで1つ)
+@st.cache_resource
+def open_background_services():
+    return BackgroundServices()
+
+# バックグラウンド照合ワーカーを起動する (設定で有効な場合のみ、プロセスで1つだけ)
+# machine_urlsは ((機器ID, API URL), ...)、取引はそれぞれの機器に照会する
+# 機器や設定が変わったら前のワーカーを止めてから起動し直す
+# ステータス通知が有効ならつながっている間は照会を減らす
+def ensure_reconcile_worker(machine_urls):
+    background = open_background_services()
+    options = get_background_reconcile_config()
+    if not options.pop('enabled'):
+        background.stop("reconcile_worker")
+        return None
+    journal = get_journal()
+
+    def start():
+        clients = {machine_id: get_client(base_url) for machine_id, base_url in machine_urls}
+        default_client = clients[machine_urls[0][0]]
+        worker = ReconcileWorker(
+            get_store(),
+            lambda uuid, machine_id: clients.get(machine_id, default_client).query(uuid),
+            writer=journal,
+            push_active=lambda: status_events_active(background),
+            **options
+        )
+        worker.start()
+        return worker
+
+    return background.ensure("reconcile_worker", (machine_urls, options, get_storage_config(), journal), start)
+
+# ステータス通知の受信を開始する (設定で有効な場合のみ、プロセスで1つだけ)
+# webhookはローカルの受信口で機器からのコールバックを受け、sseは機器ごとにイベントストリームを読む
+# webhookの受信口は機器の一覧によらず1つなので、機器が変わっても開き直さない (同じポートを二重に開かない)
+# 設定が変わったら前の受信を止めてから起動し直す
+def ensure_status_events(machine_urls):
+    background = open_background_services()
+    # 既定では無効なので、有効なときだけモジュールを読み込む
+    if not load_config().get('status_events', {}).get('enabled'):
+        background.stop("status_events")
+        return None
+    from status_events import DEFAULT_STATUS_EVENTS, SseListener, StatusEventHub, WebhookReceiver
+    options = {**DEFAULT_STATUS_EVENTS, **load_config().get('status_events', {})}
+    options.pop('enabled')
+    http_config = get_http_config()
+    journal = get_journal()
+    if options['mode'] == "webhook":
+        settings = (options, journal)
+    else:
+        settings = (machine_urls, options, journal, http_config['connect_timeout'])
+
+    def start():
+        hub = StatusEventHub(journal)
+        if options['mode'] == "webhook":
+            try:
+                receiver = WebhookReceiver(
+                    hub, options['webhook_host'], options['webhook_port'], options['webhook_path'],
+                    secret=options['webhook_secret'], stale_after=options['webhook_stale_after']
+                )
+            except (OSError, ValueError) as e:
+                # シークレットがないかポートを開けなければ、通知なしで照会を続ける
+                hub.set_channel("webhook", "error", str(e))
+            else:
+                hub.start_source(receiver)
+        else:
+            for machine_id, base_url in machine_urls:
+                hub.start_source(SseListener(
+                    hub, machine_id, base_url, options['sse_path'],
+                    connect_timeout=http_config['connect_timeout'],
+                    read_timeout=options['read_timeout'],
+                    reconnect_interval=options['reconnect_interval'],
+                    unsupported_retry_interval=options['unsupported_retry_interval']
+                ))
+        return hub
+
+    return background.ensure("status_events", settings, start)
+
+# ステータス通知がつながっているか (照会ワーカーが照会を減らすかどうかの判断に使う)
+# 通知を有効・無効にしても照会ワーカーを起動し直さなくて済むよう、そのときの受信を見る
+def status_events_active(background):
+    hub = background.get("status_events")
+    return hub is not None and hub.is_active()
+
+# 釣銭在庫の手元コピーを開く (機器ごとに全セッションで共有)
+@st.cache_resource
+def open_change_inventory(base_url, resync_interval, value_key, count_key):
+    inventory = ChangeInventory(
+        get_client(base_url).cash_info,
+        value_key,
+        count_key,
+        resync_interval=resync_interval
+    )
+    inventory.sync()
+    return inventory
+
+# 釣銭の確認 (有効にして、金種と枚数のキーを両方設定したときだけ確認する)
+def get_change_inventory(base_url):
+    change_config = {**DEFAULT_CHANGE_CHECK, **load_config().get('change_check', {})}
+    if not change_config.pop('enabled') or not change_config['value_key'] or not change_config['count_key']:
+        return None
+    return open_change_inventory(base_url, **change_config)
+
+# 一括出金の台帳を開く (全セッションで共有)
+@st.cache_resource
+def open_batch_ledger(path, ttl_days):
+    from batch import BatchLedger
+    return BatchLedger(path, ttl_days)
+
+# 機器ごとの出金間隔の制御 (全セッションで共有)
+@st.cache_resource
+def open_rate_limiter(base_url, rate_per_minute):
+    from batch import RateLimiter
+    return RateLimiter(rate_per_minute)
+
+# 一括出金の実行 (全セッションで共有、機器ごとに同時に1つだけ)
+@st.cache_resource
+def open_batch_jobs():
+    from batch import BatchJobs
+    return BatchJobs()
+
+def get_batch_config():
+    from batch import DEFAULT_BATCH
+    return {**DEFAULT_BATCH, **load_config().get('batch', {})}
+
+# テレメトリの記録 (設定で有効な場合のみ、プロセスで1つだけ)
+# 既定では無効なので、有効なときだけモジュールを読み込む。機器や設定が変わったら記録し直す
+def get_telemetry_recorder(machine_urls):
+    background = open_background_services()
+    if not load_config().get('telemetry', {}).get('enabled'):
+        background.stop("telemetry_recorder")
+        return None
+    from telemetry import DEFAULT_TELEMETRY, TelemetryRecorder
+    options = {**DEFAULT_TELEMETRY, **load_config().get('telemetry', {})}
+    options.pop('enabled')
+
+    def start():
+        recorder = TelemetryRecorder(
+            {machine_id: get_client(base_url) for machine_id, base_url in machine_urls},
+            **options
+        )
+        recorder.start()
+        return recorder
+
+    return background.ensure("telemetry_recorder", (machine_urls, options), start)
+
+# 計測値の書き出しを開始する (書き出し先が設定されている場合のみ、プロセスで1つだけ)
+# 設定が変わったら前のものを止めて (ポートを閉じて) から起動し直す
+# ポートを開けなければOSErrorになる (次の再実行でまた開き直す)
+def ensure_metrics_exporter(path, interval, host, port):
+    background = open_background_services()
+    if not METRICS.enabled or not (path or port):
+        background.stop("metrics_exporter")
+        return None
+
+    def start():
+        exporter = MetricsExporter(METRICS, path, interval, host, port)
+        exporter.start()
+        return exporter
+
+    return background.ensure("metrics_exporter", (path, interval, host, port), start)
+
+# サンプリングプロファイラ (診断画面で有効にしたときだけ動く)
+@st.cache_resource
+def open_profiler(interval_ms, max_stacks):
+    return SamplingProfiler(interval_ms, max_stacks)
+
+def get_metrics_config():
+    return {**DEFAULT_METRICS, **load_config().get('metrics', {})}
+
+# APIにログインする
+def api_login(base_url, username, password):
+    return get_client(base_url).login(username, password)
+
+# 出金処理を実行する
+def execute_withdrawal(base_url, amount):
+    return get_client(base_url).refund(amount)
+
+# トランザクションステータスを確認する
+def check_transaction_status(base_url, uuid):
+    return get_client(base_url).query(uuid)
+
+# エラーメッセージのキャッシュを開く (全セッションで共有、起動時に指定範囲を先読み)
+@st.cache_resource
+def open_error_cache(base_url, ttl, max_entries, path, prefetch_ranges, prefetch_workers):
+    cache = ErrorMessageCache(
+        get_client(base_url).error_message,
+        ttl=ttl,
+        max_entries=max_entries,
+        path=error_cache_path(path, base_url) if path else None
+    )
+    if prefetch_ranges:
+        cache.prefetch_ranges_async(prefetch_ranges, prefetch_workers)
+    return cache
+
+def get_error_cache(base_url):
+    error_cache_config = {**DEFAULT_ERROR_CACHE, **load_config().get('error_cache', {})}
+    return open_error_cache(base_url, **error_cache_config)
+
+# エラーメッセージを取得する (キャッシュにあればAPIを呼ばない)
+def get_error_message(base_url, error_code):
+    return get_error_cache(base_url).get(error_code)
+
+# システムステータスを取得する
+def get_system_status(base_url):
+    return get_client(base_url).system_status()
+
+# 機器情報を取得する
+def get_machine_info(base_url):
+    return get_client(base_url).machine_info()
+
+# 現金情報を取得する
+def get_cash_info(base_url):
+    return get_client(base_url).cash_info()
+
+# センサーステータスを取得する
+def get_sensor_status(base_url):
+    return get_client(base_url).sensor_status()
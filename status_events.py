@@ -0,0 +1,237 @@
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from reconcile import map_device_status
+
+# ステータス通知のデフォルト設定
+# mode は "webhook" (機器から受信口へ送ってもらう) か "sse" (機器のイベントストリームを読む)
+# webhook_secret は機器がコールバックのヘッダーに付ける共有シークレット (設定しないと受信口を開かない)
+# webhookは届いたかどうかでしか確かめられないので、webhook_stale_after 秒コールバックがなければ
+# 途切れたとみなして照会に戻す
+DEFAULT_STATUS_EVENTS = {
+    "enabled": False,
+    "mode": "sse",
+    "webhook_host": "127.0.0.1",
+    "webhook_port": 8765,
+    "webhook_path": "/callback/status",
+    "webhook_secret": None,
+    "webhook_stale_after": 120,
+    "sse_path": "/api/events",
+    "read_timeout": 30,
+    "reconnect_interval": 5,
+    "unsupported_retry_interval": 300
+}
+
+# コールバックの共有シークレットを入れるヘッダー
+WEBHOOK_SECRET_HEADER = "X-CashPoint-Secret"
+
+
+# イベントからUUIDと機器のステータスを取り出す (1件でも配列でも受け付ける)
+def parse_status_events(payload):
+    events = payload if isinstance(payload, list) else [payload]
+    for event in events:
+        if not isinstance(event, dict):
+            continue
+        info = event.get('info') or {}
+        uuid = event.get('uuid') or info.get('uuid')
+        status = event.get('status') or info.get('status')
+        if uuid and status:
+            yield uuid, status
+
+
+# ステータス通知の受け口
+# 受け取ったイベントを確定したステータスに変換して書き込み、通知経路ごとの状態を持つ
+class StatusEventHub:
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.sources = []
+        self.channels = {}
+        self.received = 0
+        self.applied = 0
+        self.last_event_at = None
+
+    # イベントを反映する (未確定のステータスは書き込まない)
+    def handle(self, payload):
+        updates = {}
+        for uuid, status in parse_status_events(payload):
+            new_status = map_device_status(status)
+            if new_status:
+                updates[uuid] = new_status
+        with self.lock:
+            self.received += 1
+            self.last_event_at = time.time()
+        if updates:
+            self.writer.update_statuses(updates)
+            with self.lock:
+                self.applied += len(updates)
+        return updates
+
+    # 通知経路 (受信口やイベントストリームの読み込み) を登録して動かす
+    def start_source(self, source):
+        self.sources.append(source)
+        source.start()
+
+    # 通知経路をすべて止める
+    def stop(self):
+        for source in self.sources:
+            source.stop()
+
+    # 通知経路の状態を記録する (listening / connected / disconnected / unsupported / error)
+    # stale_after を渡すと、その秒数のあいだ記録し直されなければつながっていないとみなす
+    def set_channel(self, name, state, error=None, stale_after=None):
+        with self.lock:
+            self.channels[name] = {
+                "state": state, "error": error, "changed_at": time.time(), "stale_after": stale_after
+            }
+
+    # すべての通知経路がつながっているか (ロックを取った状態で呼ぶ)
+    def _active(self):
+        now = time.time()
+        return bool(self.channels) and all(
+            channel['state'] == "connected"
+            and (channel['stale_after'] is None or now - channel['changed_at'] < channel['stale_after'])
+            for channel in self.channels.values()
+        )
+
+    # つながっていなければ照会で補う
+    def is_active(self):
+        with self.lock:
+            return self._active()
+
+    def health(self):
+        with self.lock:
+            return {
+                "active": self._active(),
+                "channels": {name: dict(channel) for name, channel in self.channels.items()},
+                "received": self.received,
+                "applied": self.applied,
+                "last_event_at": self.last_event_at
+            }
+
+
+# 機器からのコールバックを受け取るローカルの受信口
+# 共有シークレットが合わないコールバックは受け付けず、受信口を開いただけではつながったとみなさない
+# (正しいコールバックが stale_after 秒以内に届いている間だけ通知が届いているとみなす)
+class WebhookReceiver:
+    def __init__(self, hub, host="127.0.0.1", port=8765, path="/callback/status", secret=None,
+                 stale_after=120):
+        if not secret:
+            raise ValueError("webhook_secret が設定されていません")
+        self.hub = hub
+        self.path = path
+        self.secret = secret
+        self.stale_after = stale_after
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if self.path != receiver.path:
+                    self._send(404, {"isSuccess": False, "errorMsg": "not found"})
+                    return
+                if not receiver.authorized(self.headers.get(WEBHOOK_SECRET_HEADER)):
+                    self._send(401, {"isSuccess": False, "errorMsg": "unauthorized"})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    payload = json.loads(self.rfile.read(length) or b'null')
+                    receiver.hub.set_channel("webhook", "connected", stale_after=receiver.stale_after)
+                    receiver.hub.handle(payload)
+                except (ValueError, TypeError) as e:
+                    self._send(400, {"isSuccess": False, "errorMsg": str(e)})
+                    return
+                except Exception as e:
+                    self._send(500, {"isSuccess": False, "errorMsg": str(e)})
+                    return
+                self._send(200, {"isSuccess": True})
+
+            def _send(self, code, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="status-webhook", daemon=True)
+
+    # ヘッダーの共有シークレットが合っているか (比較にかかる時間で推測されないようにする)
+    def authorized(self, value):
+        return value is not None and hmac.compare_digest(value.encode('utf-8'), self.secret.encode('utf-8'))
+
+    def start(self):
+        self.thread.start()
+        self.hub.set_channel("webhook", "listening")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.hub.set_channel("webhook", "disconnected")
+
+
+# 機器のイベントストリーム (SSE) を読み続けるスレッド
+# 切れたら間隔を空けてつなぎ直し、機器が対応していなければ長めの間隔で確認し直す
+class SseListener(threading.Thread):
+    def __init__(self, hub, name, base_url, path="/api/events", connect_timeout=3.05, read_timeout=30,
+                 reconnect_interval=5, unsupported_retry_interval=300):
+        super().__init__(name=f"status-sse-{name}", daemon=True)
+        self.hub = hub
+        self.channel = name
+        self.url = f"{base_url.rstrip('/')}{path}"
+        self.timeout = (connect_timeout, read_timeout)
+        self.reconnect_interval = reconnect_interval
+        self.unsupported_retry_interval = unsupported_retry_interval
+        self.session = requests.Session()
+        self.stop_event = threading.Event()
+
+    # 1回分の接続でイベントを読む
+    def listen(self):
+        with self.session.get(self.url, stream=True, timeout=self.timeout,
+                              headers={"Accept": "text/event-stream"}) as response:
+            if response.status_code in (404, 405, 501):
+                return False
+            response.raise_for_status()
+            self.hub.set_channel(self.channel, "connected")
+            data = []
+            # イベントは短いので、まとまった量を待たずに届いた分から読む
+            for line in response.iter_lines(chunk_size=1, decode_unicode=True):
+                if self.stop_event.is_set():
+                    break
+                if line is None:
+                    continue
+                if line.startswith("data:"):
+                    data.append(line[5:].strip())
+                elif line == "" and data:
+                    try:
+                        self.hub.handle(json.loads("\n".join(data)))
+                    except ValueError:
+                        pass
+                    data = []
+        return True
+
+    def run(self):
+        self.hub.set_channel(self.channel, "disconnected")
+        while not self.stop_event.is_set():
+            try:
+                supported = self.listen()
+                if not supported:
+                    self.hub.set_channel(self.channel, "unsupported")
+                    self.stop_event.wait(self.unsupported_retry_interval)
+                    continue
+                self.hub.set_channel(self.channel, "disconnected")
+            except requests.exceptions.RequestException as e:
+                self.hub.set_channel(self.channel, "disconnected", str(e))
+            self.stop_event.wait(self.reconnect_interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.session.close()
@@ -0,0 +1,717 @@
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+from config_file import DEFAULT_MACHINE_ID
+from metrics import METRICS
+
+# トランザクションの列定義
+TRANSACTION_COLUMNS = ['日時', '応対者名', 'お支払先', '勘定項目', '出金金額', 'UUID', 'ステータス', '機器ID']
+
+# 処理が終わったステータス
+FINAL_STATUSES = ['完了', '失敗']
+
+# インデックスを張る列
+INDEXED_COLUMNS = ['UUID', '日時', 'ステータス', '応対者名', '機器ID']
+
+# カテゴリ型で持つ列
+CATEGORY_COLUMNS = ['応対者名', 'ステータス', '勘定項目', '機器ID']
+
+
+# 日別集計を取る列
+ROLLUP_DIMENSIONS = ['勘定項目', '応対者名', 'お支払先']
+
+# 日別集計の値 (全件・完了・失敗それぞれの件数と出金金額の合計)
+ROLLUP_COLUMNS = ['count', 'amount', 'completed_count', 'completed_amount', 'failed_count', 'failed_amount']
+
+# 日別集計の値の表示名
+ROLLUP_LABELS = {
+    'count': '件数', 'amount': '出金金額',
+    'completed_count': '完了件数', 'completed_amount': '完了金額',
+    'failed_count': '失敗件数', 'failed_amount': '失敗金額'
+}
+
+
+# 列の型をそろえる (日時はdatetime、金額は整数、繰り返しの多い列はカテゴリ)
+def coerce_dtypes(df):
+    df = df.copy()
+    df['日時'] = pd.to_datetime(df['日時'], errors='coerce')
+    df['出金金額'] = pd.to_numeric(df['出金金額'], errors='coerce').fillna(0).astype('int64')
+    df['機器ID'] = df['機器ID'].astype(object).fillna(DEFAULT_MACHINE_ID) if '機器ID' in df else DEFAULT_MACHINE_ID
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('category')
+    return df
+
+
+# CSVファイルに保存するストレージ (従来形式)
+class CsvTransactionStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.rollups = None
+        if not os.path.exists(self.path):
+            pd.DataFrame(columns=TRANSACTION_COLUMNS).to_csv(self.path, index=False)
+        else:
+            # 機器IDの列がない古いファイルに追加する
+            df = pd.read_csv(self.path, dtype={'UUID': str})
+            if '機器ID' not in df.columns:
+                df['機器ID'] = DEFAULT_MACHINE_ID
+                df.to_csv(self.path, index=False)
+
+    # 全トランザクションを読み込む
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="load")
+    def load(self):
+        with self.lock:
+            return pd.read_csv(self.path, dtype={'UUID': str})
+
+    # 1行を末尾に追記する
+    def append(self, record):
+        self.append_many([record])
+
+    # 複数行をまとめて末尾に追記する
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="append_many")
+    def append_many(self, records):
+        with self.lock:
+            with open(self.path, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                for record in records:
+                    writer.writerow([record.get(column, '') for column in TRANSACTION_COLUMNS])
+            if self.rollups is not None:
+                rollup_records(records, self.rollups)
+
+    # ステータスを更新する (CSVは全体を書き直す)
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="update_statuses")
+    def update_statuses(self, updates):
+        if not updates:
+            return 0
+        with self.lock:
+            df = pd.read_csv(self.path, dtype={'UUID': str})
+            new_statuses = df['UUID'].map(updates)
+            before = df[new_statuses.notna()].copy()
+            df['ステータス'] = new_statuses.combine_first(df['ステータス'].astype(object))
+            df.to_csv(self.path, index=False)
+            self.generation += 1
+            if self.rollups is not None:
+                after = df[new_statuses.notna()]
+                rollup_records(before.to_dict('records'), self.rollups, sign=-1)
+                rollup_records(after.to_dict('records'), self.rollups)
+            return int(new_statuses.notna().sum())
+
+    # 前回からの変更を取得する
+    # 追記だけなら増えた末尾のみを読み、書き直されていれば全体を読み直す
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="changes_since")
+    def changes_since(self, cursor):
+        with self.lock:
+            stat = os.stat(self.path)
+            # カーソルは (書き直し回数, サイズ, 更新時刻, 行数)
+            if cursor is not None and cursor[:3] == (self.generation, stat.st_size, stat.st_mtime_ns):
+                return cursor, None, False
+            if cursor is not None and cursor[0] == self.generation and cursor[1] < stat.st_size:
+                with open(self.path, 'rb') as f:
+                    f.seek(cursor[1])
+                    tail = f.read(stat.st_size - cursor[1])
+                df = pd.read_csv(io.BytesIO(tail), header=None, names=TRANSACTION_COLUMNS,
+                                 dtype={'UUID': str})
+                df.index = pd.RangeIndex(cursor[3], cursor[3] + len(df))
+                rows = cursor[3] + len(df)
+                return (self.generation, stat.st_size, stat.st_mtime_ns, rows), df, False
+            df = pd.read_csv(self.path, dtype={'UUID': str})
+            return (self.generation, stat.st_size, stat.st_mtime_ns, len(df)), df, True
+
+    # 条件に合うトランザクションを取得する
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="query")
+    def query(self, start=None, end=None, operators=None, statuses=None, machines=None):
+        return filter_transactions(self.load(), start, end, operators, statuses, machines)
+
+    # 条件に合うトランザクションを少しずつ読み出す
+    def iter_query(self, start=None, end=None, operators=None, statuses=None, machines=None,
+                   chunksize=50000):
+        for chunk in pd.read_csv(self.path, dtype={'UUID': str}, chunksize=chunksize):
+            chunk = filter_transactions(chunk, start, end, operators, statuses, machines)
+            if not chunk.empty:
+                yield chunk
+
+    # 月ごとの件数をまとめる
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="month_summaries")
+    def month_summaries(self):
+        return summarize_months(self.load())
+
+    # 絞り込みの選択肢
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="filter_options")
+    def filter_options(self, start=None):
+        return summarize_filter_options(filter_transactions(self.load(), start))
+
+    # 未完了のトランザクションの (UUID, 日時, 機器ID) を取得する
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="pending_transactions")
+    def pending_transactions(self):
+        df = self.load()
+        df = df[~df['ステータス'].isin(FINAL_STATUSES) & df['UUID'].notna()]
+        return list(zip(df['UUID'], df['日時'], df['機器ID'].fillna(DEFAULT_MACHINE_ID)))
+
+    # 指定したUUIDが登録済みか確認する
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="existing_uuids")
+    def existing_uuids(self, uuids):
+        with self.lock:
+            saved = pd.read_csv(self.path, usecols=['UUID'], dtype={'UUID': str})['UUID']
+        return set(uuids) & set(saved.dropna())
+
+    # 日別集計を取得する (集計はメモリに持ち、初回に全件から作る)
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="daily_rollups")
+    def daily_rollups(self, start=None, end=None, dimension='勘定項目'):
+        with self.lock:
+            if self.rollups is None:
+                self.rollups = rollup_records(pd.read_csv(self.path, dtype={'UUID': str}).to_dict('records'))
+            return filter_rollups(self.rollups, start, end, dimension)
+
+    # 日別集計を全件から作り直す
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="rebuild_rollups")
+    def rebuild_rollups(self):
+        with self.lock:
+            self.rollups = rollup_records(pd.read_csv(self.path, dtype={'UUID': str}).to_dict('records'))
+            return len(self.rollups)
+
+    # 書き込んだ内容をディスクに書き出す
+    @METRICS.timed("cashpoint_storage_seconds", backend="csv", operation="sync")
+    def sync(self):
+        with self.lock:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        pass
+
+
+# SQLite (WALモード) に保存するストレージ
+class SqliteTransactionStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    # テーブルとインデックスを作成する
+    def _create_schema(self):
+        with self.lock, self.conn:
+            has_rollups = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_rollups'"
+            ).fetchone() is not None
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS transactions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    "日時" TEXT NOT NULL,
+                    "応対者名" TEXT,
+                    "お支払先" TEXT,
+                    "勘定項目" TEXT,
+                    "出金金額" INTEGER,
+                    "UUID" TEXT,
+                    "ステータス" TEXT,
+                    rev INTEGER,
+                    "機器ID" TEXT
+                )
+                """
+            )
+            # 変更番号の列がない古いデータベースに追加する
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(transactions)")]
+            if 'rev' not in columns:
+                self.conn.execute("ALTER TABLE transactions ADD COLUMN rev INTEGER")
+                self.conn.execute("UPDATE transactions SET rev = id")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_rev ON transactions (rev)")
+            # 機器IDの列がない古いデータベースに追加する
+            if '機器ID' not in columns:
+                self.conn.execute('ALTER TABLE transactions ADD COLUMN "機器ID" TEXT')
+                self.conn.execute('UPDATE transactions SET "機器ID" = ?', (DEFAULT_MACHINE_ID,))
+            for column in INDEXED_COLUMNS:
+                self.conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS "idx_transactions_{column}" ON transactions ("{column}")'
+                )
+            # 日別集計 (取引の追加とステータス更新と同じトランザクションで更新する)
+            self.conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS daily_rollups (
+                    dimension TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    {', '.join(f'{column} INTEGER NOT NULL DEFAULT 0' for column in ROLLUP_COLUMNS)},
+                    PRIMARY KEY (dimension, day, value)
+                )
+                """
+            )
+            # 集計表がなかった古いデータベースは既存の取引から作る
+            if not has_rollups:
+                self._rebuild_rollups()
+
+    # 全トランザクションを読み込む
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="load")
+    def load(self):
+        columns = ', '.join(f'"{column}"' for column in TRANSACTION_COLUMNS)
+        with self.lock:
+            return pd.read_sql_query(f"SELECT {columns} FROM transactions ORDER BY id", self.conn)
+
+    # 次の変更番号を取得する
+    def _next_rev(self):
+        return self.conn.execute("SELECT COALESCE(MAX(rev), 0) + 1 FROM transactions").fetchone()[0]
+
+    # 1行を追加する
+    def append(self, record):
+        self.append_many([record])
+
+    # 複数行を1トランザクションで追加する
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="append_many")
+    def append_many(self, records):
+        columns = ', '.join(f'"{column}"' for column in TRANSACTION_COLUMNS)
+        placeholders = ', '.join('?' for _ in TRANSACTION_COLUMNS)
+        with self.lock, self.conn:
+            rev = self._next_rev()
+            rows = [
+                [record.get(column) for column in TRANSACTION_COLUMNS] + [rev + i]
+                for i, record in enumerate(records)
+            ]
+            self.conn.executemany(
+                f"INSERT INTO transactions ({columns}, rev) VALUES ({placeholders}, ?)", rows
+            )
+            self._apply_rollups(rollup_records(records))
+
+    # ステータスを該当行だけ更新する
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="update_statuses")
+    def update_statuses(self, updates):
+        if not updates:
+            return 0
+        with self.lock, self.conn:
+            before = self._select_by_uuid(updates)
+            rev = self._next_rev()
+            cursor = self.conn.executemany(
+                'UPDATE transactions SET "ステータス" = ?, rev = ? WHERE "UUID" = ?',
+                [(status, rev, uuid) for uuid, status in updates.items()]
+            )
+            after = [{**record, 'ステータス': updates[record['UUID']]} for record in before]
+            self._apply_rollups(rollup_delta(before, after))
+            return cursor.rowcount
+
+    # 指定したUUIDの取引を辞書のリストで読む (ロックを取った状態で呼ぶ)
+    def _select_by_uuid(self, uuids):
+        uuids = list(uuids)
+        columns = ', '.join(f'"{column}"' for column in TRANSACTION_COLUMNS)
+        records = []
+        for start in range(0, len(uuids), 500):
+            chunk = uuids[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            rows = self.conn.execute(
+                f'SELECT {columns} FROM transactions WHERE "UUID" IN ({placeholders})', chunk
+            ).fetchall()
+            records.extend(dict(zip(TRANSACTION_COLUMNS, row)) for row in rows)
+        return records
+
+    # 集計値の差分を日別集計に足し込む (ロックとトランザクションの中で呼ぶ)
+    def _apply_rollups(self, delta):
+        if not delta:
+            return
+        columns = ', '.join(ROLLUP_COLUMNS)
+        placeholders = ', '.join('?' for _ in ROLLUP_COLUMNS)
+        increments = ', '.join(f'{column} = {column} + excluded.{column}' for column in ROLLUP_COLUMNS)
+        rows = [(dimension, day, value, *total) for (day, dimension, value), total in delta.items()]
+        self.conn.executemany(
+            f"INSERT INTO daily_rollups (dimension, day, value, {columns}) VALUES (?, ?, ?, {placeholders}) "
+            f"ON CONFLICT (dimension, day, value) DO UPDATE SET {increments}",
+            rows
+        )
+
+    # 日別集計を全件から作り直す (ロックとトランザクションの中で呼ぶ)
+    def _rebuild_rollups(self, chunksize=100000):
+        columns = ', '.join(f'"{column}"' for column in TRANSACTION_COLUMNS)
+        self.conn.execute("DELETE FROM daily_rollups")
+        rollups = {}
+        cursor = self.conn.execute(f"SELECT {columns} FROM transactions")
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            rollup_records((dict(zip(TRANSACTION_COLUMNS, row)) for row in rows), rollups)
+        self._apply_rollups(rollups)
+        return len(rollups)
+
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="rebuild_rollups")
+    def rebuild_rollups(self):
+        with self.lock, self.conn:
+            return self._rebuild_rollups()
+
+    # 日別集計を取得する (日数×値の数だけ読む)
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="daily_rollups")
+    def daily_rollups(self, start=None, end=None, dimension='勘定項目'):
+        conditions = ["dimension = ?"]
+        params = [dimension]
+        if start is not None:
+            conditions.append("day >= ?")
+            params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+        if end is not None:
+            conditions.append("day < ?")
+            params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+        with self.lock:
+            return pd.read_sql_query(
+                f"SELECT day, value, {', '.join(ROLLUP_COLUMNS)} FROM daily_rollups "
+                f"WHERE {' AND '.join(conditions)} ORDER BY day, value",
+                self.conn, params=params
+            )
+
+    # 前回からの変更を取得する (変更番号より新しい行だけを読む)
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="changes_since")
+    def changes_since(self, cursor):
+        columns = ', '.join(f'"{column}"' for column in TRANSACTION_COLUMNS)
+        with self.lock:
+            latest = self.conn.execute("SELECT MAX(rev) FROM transactions").fetchone()[0]
+            if latest is None or (cursor is not None and latest <= cursor):
+                return cursor, None, False
+            df = pd.read_sql_query(
+                f"SELECT id, {columns}, rev FROM transactions WHERE rev > ? ORDER BY id",
+                self.conn, params=(cursor or 0,), index_col='id'
+            )
+        if df.empty:
+            return cursor, None, False
+        return int(df['rev'].max()), df.drop(columns='rev'), cursor is None
+
+    # 条件に合うトランザクションを取得する (インデックスで絞り込む)
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="query")
+    def query(self, start=None, end=None, operators=None, statuses=None, machines=None):
+        sql, params = self._select(start, end, operators, statuses, machines)
+        with self.lock:
+            df = pd.read_sql_query(sql, self.conn, params=params)
+        return coerce_dtypes(df)
+
+    # 条件に合うトランザクションを少しずつ読み出す
+    # 書き込みを止めないよう、読み取り専用の別接続を使う
+    def iter_query(self, start=None, end=None, operators=None, statuses=None, machines=None,
+                   chunksize=50000):
+        sql, params = self._select(start, end, operators, statuses, machines)
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            yield from pd.read_sql_query(sql, conn, params=params, chunksize=chunksize)
+        finally:
+            conn.close()
+
+    # 検索用のSQLを組み立てる
+    def _select(self, start, end, operators, statuses, machines):
+        columns = ', '.join(f'"{column}"' for column in TRANSACTION_COLUMNS)
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append('"日時" >= ?')
+            params.append(pd.Timestamp(start).strftime('%Y-%m-%d %H:%M:%S'))
+        if end is not None:
+            conditions.append('"日時" < ?')
+            params.append(pd.Timestamp(end).strftime('%Y-%m-%d %H:%M:%S'))
+        for column, values in [('応対者名', operators), ('ステータス', statuses), ('機器ID', machines)]:
+            if values:
+                conditions.append(f'"{column}" IN ({", ".join("?" for _ in values)})')
+                params.extend(values)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return f"SELECT {columns} FROM transactions {where} ORDER BY id", params
+
+    # 月ごとの件数・未完了件数・最後の未完了の日時・変更番号をまとめる
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="month_summaries")
+    def month_summaries(self):
+        placeholders = ', '.join('?' for _ in FINAL_STATUSES)
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT substr("日時", 1, 7) AS month, COUNT(*), '
+                f'SUM(CASE WHEN "ステータス" IN ({placeholders}) THEN 0 ELSE 1 END), '
+                f'MAX(CASE WHEN "ステータス" IN ({placeholders}) THEN NULL ELSE "日時" END), MAX(rev) '
+                f'FROM transactions GROUP BY month ORDER BY month',
+                FINAL_STATUSES + FINAL_STATUSES
+            ).fetchall()
+        return [
+            {'month': month, 'rows': count, 'pending': pending, 'pending_last': pending_last, 'rev': rev}
+            for month, count, pending, pending_last, rev in rows
+        ]
+
+    # 絞り込みの選択肢 (日時の範囲と、応対者名・ステータス・機器IDの値) をインデックスから求める
+    # startを省略したときは値ごとにインデックスを飛ばして読み、全件は走査しない
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="filter_options")
+    def filter_options(self, start=None):
+        where, params = "", []
+        if start is not None:
+            where, params = 'WHERE "日時" >= ?', [pd.Timestamp(start).strftime('%Y-%m-%d %H:%M:%S')]
+        options = {}
+        with self.lock:
+            # MINとMAXを1つのSELECTにまとめるとインデックスを全件走査するので分ける
+            options['min'], options['max'] = self.conn.execute(
+                f'SELECT (SELECT MIN("日時") FROM transactions {where}), '
+                f'(SELECT MAX("日時") FROM transactions {where})',
+                params + params
+            ).fetchone()
+            for key, column in [('operators', '応対者名'), ('statuses', 'ステータス'), ('machines', '機器ID')]:
+                if start is None:
+                    sql = (
+                        f'WITH RECURSIVE v(value) AS ('
+                        f'SELECT MIN("{column}") FROM transactions UNION ALL '
+                        f'SELECT (SELECT MIN("{column}") FROM transactions WHERE "{column}" > v.value) '
+                        f'FROM v WHERE v.value IS NOT NULL) '
+                        f'SELECT value FROM v WHERE value IS NOT NULL'
+                    )
+                else:
+                    # 値の列のインデックスを全件走査しないよう、日時のインデックスで範囲を読む
+                    sql = f'SELECT DISTINCT "{column}" FROM transactions INDEXED BY "idx_transactions_日時" {where}'
+                options[key] = sorted(str(row[0]) for row in self.conn.execute(sql, params) if row[0] is not None)
+            # 機器IDのない行は既定の機器として扱う
+            no_machine = self.conn.execute(
+                f'SELECT 1 FROM transactions {where} {"AND" if where else "WHERE"} "機器ID" IS NULL LIMIT 1',
+                params
+            ).fetchone()
+        if no_machine and DEFAULT_MACHINE_ID not in options['machines']:
+            options['machines'] = sorted(options['machines'] + [DEFAULT_MACHINE_ID])
+        return options
+
+    # 未完了のトランザクションの (UUID, 日時, 機器ID) を取得する
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="pending_transactions")
+    def pending_transactions(self):
+        placeholders = ', '.join('?' for _ in FINAL_STATUSES)
+        with self.lock:
+            return self.conn.execute(
+                f'SELECT "UUID", "日時", COALESCE("機器ID", ?) FROM transactions '
+                f'WHERE ("ステータス" IS NULL OR "ステータス" NOT IN ({placeholders})) '
+                f'AND "UUID" IS NOT NULL ORDER BY id',
+                [DEFAULT_MACHINE_ID] + FINAL_STATUSES
+            ).fetchall()
+
+    # 指定したUUIDが登録済みか確認する
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="existing_uuids")
+    def existing_uuids(self, uuids):
+        uuids = list(uuids)
+        found = set()
+        with self.lock:
+            for start in range(0, len(uuids), 500):
+                chunk = uuids[start:start + 500]
+                placeholders = ', '.join('?' for _ in chunk)
+                rows = self.conn.execute(
+                    f'SELECT "UUID" FROM transactions WHERE "UUID" IN ({placeholders})', chunk
+                ).fetchall()
+                found.update(row[0] for row in rows)
+        return found
+
+    # 書き込んだ内容をディスクに書き出す
+    # synchronous=NORMALではコミットごとにfsyncしないため、WALファイルをまとめてfsyncする
+    @METRICS.timed("cashpoint_storage_seconds", backend="sqlite", operation="sync")
+    def sync(self):
+        with self.lock:
+            wal_path = self.path + "-wal"
+            if not os.path.exists(wal_path):
+                return
+            fd = os.open(wal_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# 取引を (日付, 集計列, 値) ごとの集計値にする
+# 1件ずつの追加でも軽いよう、DataFrameではなく辞書で数える
+def rollup_records(records, rollups=None, sign=1):
+    rollups = {} if rollups is None else rollups
+    for record in records:
+        try:
+            amount = int(record.get('出金金額'))
+        except (TypeError, ValueError):
+            amount = 0
+        status = record.get('ステータス')
+        completed = status == '完了'
+        failed = status == '失敗'
+        counts = (1, amount, int(completed), amount * completed, int(failed), amount * failed)
+        day = str(record.get('日時'))[:10]
+        for dimension in ROLLUP_DIMENSIONS:
+            value = record.get(dimension)
+            key = (day, dimension, '' if value is None or value != value else str(value))
+            total = rollups.setdefault(key, [0] * len(ROLLUP_COLUMNS))
+            for i, count in enumerate(counts):
+                total[i] += sign * count
+    return rollups
+
+
+# ステータス変更による集計値の差分 (変更前と変更後の行から求める)
+def rollup_delta(before, after):
+    delta = rollup_records(after)
+    rollup_records(before, delta, sign=-1)
+    return {key: total for key, total in delta.items() if any(total)}
+
+
+# 日別集計を日付と集計列で絞り込む
+def filter_rollups(rollups, start, end, dimension):
+    start = pd.Timestamp(start).strftime('%Y-%m-%d') if start is not None else None
+    end = pd.Timestamp(end).strftime('%Y-%m-%d') if end is not None else None
+    rows = [
+        (day, value, *total)
+        for (day, key_dimension, value), total in rollups.items()
+        if key_dimension == dimension and (start is None or day >= start) and (end is None or day < end)
+    ]
+    return pd.DataFrame(sorted(rows), columns=['day', 'value'] + ROLLUP_COLUMNS)
+
+
+# DataFrameを条件で絞り込む (CSVストレージ用)
+def filter_transactions(df, start=None, end=None, operators=None, statuses=None, machines=None):
+    df = coerce_dtypes(df)
+    mask = pd.Series(True, index=df.index)
+    if start is not None:
+        mask &= df['日時'] >= pd.Timestamp(start)
+    if end is not None:
+        mask &= df['日時'] < pd.Timestamp(end)
+    if operators:
+        mask &= df['応対者名'].isin(operators)
+    if statuses:
+        mask &= df['ステータス'].isin(statuses)
+    if machines:
+        mask &= df['機器ID'].isin(machines)
+    return df[mask]
+
+
+# 月ごとの件数・未完了件数・最後の未完了の日時・変更番号をまとめる (CSVストレージ用)
+# CSVには変更番号がないので、月のUUIDとステータスのハッシュを代わりに使う
+def summarize_months(df):
+    df = coerce_dtypes(df)
+    summary = pd.DataFrame({
+        'month': df['日時'].dt.strftime('%Y-%m'),
+        'pending': ~df['ステータス'].isin(FINAL_STATUSES),
+        '日時': df['日時'],
+        'UUID': df['UUID'].astype(str),
+        'ステータス': df['ステータス'].astype(str)
+    }).groupby('month')
+    months = []
+    for month, group in summary:
+        pending_dates = group.loc[group['pending'], '日時'].dropna()
+        months.append({
+            'month': month,
+            'rows': len(group),
+            'pending': int(group['pending'].sum()),
+            'pending_last': pending_dates.max().strftime('%Y-%m-%d %H:%M:%S') if not pending_dates.empty else None,
+            'rev': int(pd.util.hash_pandas_object(group[['UUID', 'ステータス']], index=False).sum())
+        })
+    return months
+
+
+# 絞り込みの選択肢をまとめる (CSVストレージ用)
+def summarize_filter_options(df):
+    dates = df['日時'].dropna()
+    return {
+        'min': dates.min() if not dates.empty else None,
+        'max': dates.max() if not dates.empty else None,
+        'operators': sorted(df['応対者名'].dropna().astype(str).unique().tolist()),
+        'statuses': sorted(df['ステータス'].dropna().astype(str).unique().tolist()),
+        'machines': sorted(df['機器ID'].dropna().astype(str).unique().tolist()),
+    }
+
+
+# 変更があった分だけ読み直すトランザクションのキャッシュ
+# 返すDataFrameは共有されるので、呼び出し側で書き換えないこと
+class CachedTransactionLoader:
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.df = coerce_dtypes(pd.DataFrame(columns=TRANSACTION_COLUMNS))
+
+    # トランザクションを読み込む (変更がなければキャッシュを返す)
+    def load(self):
+        with self.lock:
+            cursor, changes, full = self.store.changes_since(self.cursor)
+            if changes is not None:
+                changes = coerce_dtypes(changes)
+                if full:
+                    self.df = changes
+                else:
+                    self.df = self._merge(self.df, changes)
+            self.cursor = cursor
+            return self.df
+
+    # 変更された行を差し替え、新しい行を追加する
+    def _merge(self, df, changes):
+        merged = pd.concat([df.drop(index=changes.index.intersection(df.index)), changes])
+        if not merged.index.is_monotonic_increasing:
+            merged = merged.sort_index()
+        for column in CATEGORY_COLUMNS:
+            if merged[column].dtype != 'category':
+                merged[column] = merged[column].astype('category')
+        return merged
+
+
+# 利用可能なストレージエンジン
+STORE_BACKENDS = {
+    'sqlite': SqliteTransactionStore,
+    'csv': CsvTransactionStore,
+}
+
+
+# ストレージを開く
+def open_store(backend, path):
+    if backend not in STORE_BACKENDS:
+        raise ValueError(f"不明なストレージ: {backend}")
+    return STORE_BACKENDS[backend](path)
+
+
+# 日時の新しい順に1ページ分を取り出す (全体は並べ替えず、必要な上位だけを選ぶ)
+# pyarrowを読み込まずに使えるよう、履歴の画面以外からも使うものはここに置く
+def latest_page(df, page=0, page_size=50):
+    top = df.nlargest((page + 1) * page_size, '日時')
+    return top.iloc[page * page_size:]
+
+
+# ページ数を返す
+def page_count(total, page_size):
+    return max(1, -(-total // page_size))
+
+
+# 既存のCSVをSQLiteへ取り込む (取り込み済みのUUIDはスキップ)
+def migrate_csv_to_sqlite(csv_path, sqlite_path, chunksize=10000):
+    store = SqliteTransactionStore(sqlite_path)
+    imported = 0
+    try:
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype={'UUID': str}):
+            chunk = chunk.reindex(columns=TRANSACTION_COLUMNS)
+            chunk['機器ID'] = chunk['機器ID'].fillna(DEFAULT_MACHINE_ID)
+            chunk = chunk[~chunk['UUID'].isin(store.existing_uuids(chunk['UUID'].dropna()))]
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            store.append_many(chunk.to_dict('records'))
+            imported += len(chunk)
+    finally:
+        store.close()
+    return imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="トランザクションストレージの管理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="CSVをSQLiteへ取り込む")
+    migrate_parser.add_argument("csv_path", nargs="?", default="transactions.csv")
+    migrate_parser.add_argument("sqlite_path", nargs="?", default="transactions.db")
+
+    rollup_parser = subparsers.add_parser("rebuild-rollups", help="日別集計を全件から作り直す")
+    # CSVの日別集計はファイルに保存せずプロセスごとにメモリ上で作るので、作り直せるのはSQLiteだけ
+    rollup_parser.add_argument(
+        "--backend", choices=["sqlite"], default="sqlite",
+        help="CSVの日別集計は保存されず、アプリが初回の集計時に全件から作ります"
+    )
+    rollup_parser.add_argument("path", nargs="?", default="transactions.db")
+
+    args = parser.parse_args()
+    if args.command == "migrate":
+        count = migrate_csv_to_sqlite(args.csv_path, args.sqlite_path)
+        print(f"{count}件のトランザクションを取り込みました")
+    elif args.command == "rebuild-rollups":
+        store = open_store(args.backend, args.path)
+        try:
+            count = store.rebuild_rollups()
+        finally:
+            store.close()
+        print(f"{count}件の日別集計を作り直しました")
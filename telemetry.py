@@ -0,0 +1,217 @@
+import csv
+import os
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# テレメトリのデフォルト設定
+DEFAULT_TELEMETRY = {
+    "enabled": False,
+    "interval": 5,
+    "capacity": 17280,
+    "max_metrics": 128,
+    "rollup_interval": 60,
+    "path": "telemetry",
+    "max_points": 500
+}
+
+# 記録するエンドポイント
+TELEMETRY_SOURCES = ["sensor_status", "cash_info"]
+
+# 集計ファイルの列
+ROLLUP_COLUMNS = ['time', 'metric', 'min', 'max', 'last']
+
+# グラフ用の時系列の列 (生のサンプルは最小・最大・最後がすべて同じ値)
+SERIES_COLUMNS = ['time', 'metric', 'min', 'max', 'last']
+
+
+# 応答のJSONから数値の項目を取り出す (例: cash_info.note.0.count)
+def flatten_metrics(prefix, value, out):
+    if isinstance(value, bool):
+        out[prefix] = float(value)
+    elif isinstance(value, (int, float)):
+        out[prefix] = float(value)
+    elif isinstance(value, str):
+        try:
+            out[prefix] = float(value)
+        except ValueError:
+            pass
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            flatten_metrics(f"{prefix}.{key}", item, out)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            flatten_metrics(f"{prefix}.{index}", item, out)
+    return out
+
+
+# 固定長の配列に記録するリングバッファ (古いサンプルから上書きする)
+class RingBuffer:
+    def __init__(self, capacity, max_metrics):
+        self.capacity = capacity
+        self.max_metrics = max_metrics
+        self.times = np.full(capacity, np.nan)
+        self.values = np.full((capacity, max_metrics), np.nan, dtype=np.float32)
+        self.metrics = {}
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # サンプルを1件追加する (項目数の上限を超えた新しい項目は記録しない)
+    def append(self, timestamp, sample):
+        with self.lock:
+            row = self.count % self.capacity
+            self.times[row] = timestamp
+            self.values[row] = np.nan
+            for name, value in sample.items():
+                column = self.metrics.get(name)
+                if column is None:
+                    if len(self.metrics) >= self.max_metrics:
+                        continue
+                    column = self.metrics[name] = len(self.metrics)
+                self.values[row, column] = value
+            self.count += 1
+
+    # 指定時刻以降のサンプルを古い順に返す
+    def window(self, since=None):
+        with self.lock:
+            size = min(self.count, self.capacity)
+            order = (np.arange(size) + self.count - size) % self.capacity
+            times = self.times[order]
+            values = self.values[order]
+            names = dict(self.metrics)
+        if since is not None:
+            mask = times >= since
+            times, values = times[mask], values[mask]
+        return times, values, names
+
+
+# 集計ファイルを読み込む (更新されていなければ前回の内容を使う)
+@lru_cache(maxsize=64)
+def read_rollup_file(path, mtime):
+    return pd.read_csv(path)
+
+
+# センサーと現金情報を定期的に記録するスレッド
+# サンプルはリングバッファに持ち、一定間隔で最小・最大・最後の値に集計してファイルに追記する
+class TelemetryRecorder(threading.Thread):
+    def __init__(self, clients, interval=5, capacity=17280, max_metrics=128, rollup_interval=60,
+                 path="telemetry", max_points=500):
+        super().__init__(name="telemetry-recorder", daemon=True)
+        self.clients = clients
+        self.interval = interval
+        self.rollup_interval = rollup_interval
+        self.path = path
+        self.max_points = max_points
+        self.buffers = {machine_id: RingBuffer(capacity, max_metrics) for machine_id in clients}
+        self.last_rollup = {machine_id: time.time() for machine_id in clients}
+        self.stop_event = threading.Event()
+        self.last_error = None
+
+    # 全機器から1回ずつサンプルを取る
+    def sample(self, now):
+        for machine_id, client in self.clients.items():
+            values = {}
+            for source in TELEMETRY_SOURCES:
+                success, data = getattr(client, source)()
+                if success:
+                    flatten_metrics(source, data, values)
+                else:
+                    self.last_error = f"{machine_id} {source}: {data}"
+            if values:
+                self.buffers[machine_id].append(now, values)
+
+    # 前回の集計以降のサンプルを集計してファイルに追記する
+    def compact(self, machine_id, now):
+        since = self.last_rollup[machine_id]
+        times, values, names = self.buffers[machine_id].window(since)
+        self.last_rollup[machine_id] = now
+        if len(times) == 0:
+            return 0
+        rows = []
+        for name, column in names.items():
+            series = values[:, column]
+            valid = series[~np.isnan(series)]
+            if len(valid):
+                rows.append([now, name, float(valid.min()), float(valid.max()), float(valid[-1])])
+
+        directory = os.path.join(self.path, machine_id)
+        os.makedirs(directory, exist_ok=True)
+        file_path = os.path.join(directory, datetime.fromtimestamp(now).strftime('%Y-%m-%d') + ".csv")
+        is_new = not os.path.exists(file_path)
+        with open(file_path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(ROLLUP_COLUMNS)
+            writer.writerows(rows)
+        return len(rows)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            now = time.time()
+            try:
+                self.sample(now)
+                for machine_id in self.clients:
+                    if now - self.last_rollup[machine_id] >= self.rollup_interval:
+                        self.compact(machine_id, now)
+            except Exception as e:
+                self.last_error = str(e)
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+
+    # 記録されている項目名
+    def metric_names(self, machine_id):
+        return sorted(self.buffers[machine_id].metrics)
+
+    # 集計ファイルから指定期間の値を読む
+    def read_rollups(self, machine_id, start, end):
+        directory = os.path.join(self.path, machine_id)
+        frames = []
+        for day in pd.date_range(datetime.fromtimestamp(start).date(), datetime.fromtimestamp(end).date()):
+            file_path = os.path.join(directory, day.strftime('%Y-%m-%d') + ".csv")
+            if os.path.exists(file_path):
+                frames.append(read_rollup_file(file_path, os.path.getmtime(file_path)))
+        if not frames:
+            return pd.DataFrame(columns=ROLLUP_COLUMNS)
+        df = pd.concat(frames, ignore_index=True)
+        return df[(df['time'] >= start) & (df['time'] <= end)]
+
+    # グラフ用の時系列を返す (列は time, metric, min, max, last、点数がmax_points以下になるよう間引く)
+    # リングバッファにある期間は生のサンプル、それより前は集計値を使う
+    # 間引くときも区間内の最小・最大を残すので、一時的な詰まりや残量の落ち込みが消えない
+    def series(self, machine_id, metrics, start, end=None):
+        end = end or time.time()
+        times, values, names = self.buffers[machine_id].window(start)
+        buffer_start = times[0] if len(times) else end
+
+        frames = []
+        rollups = self.read_rollups(machine_id, start, buffer_start)
+        rollups = rollups[rollups['metric'].isin(metrics) & (rollups['time'] < buffer_start)]
+        if not rollups.empty:
+            frames.append(rollups[SERIES_COLUMNS])
+        for metric in metrics:
+            if metric not in names:
+                continue
+            series = values[:, names[metric]]
+            valid = ~np.isnan(series)
+            if valid.any():
+                frames.append(pd.DataFrame({
+                    'time': times[valid], 'metric': metric,
+                    'min': series[valid], 'max': series[valid], 'last': series[valid]
+                }))
+        if not frames:
+            return pd.DataFrame(columns=SERIES_COLUMNS)
+
+        df = pd.concat(frames, ignore_index=True)
+        df['time'] = pd.to_datetime(df['time'], unit='s')
+        if df['time'].nunique() > self.max_points:
+            bucket = (df['time'].max() - df['time'].min()) / self.max_points
+            df = df.sort_values('time', kind='stable').groupby(
+                ['metric', pd.Grouper(key='time', freq=bucket)]
+            ).agg(min=('min', 'min'), max=('max', 'max'), last=('last', 'last')).dropna(how='all').reset_index()
+        return df.sort_values(['metric', 'time'], kind='stable').reset_index(drop=True)[SERIES_COLUMNS]
@@ -0,0 +1,133 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+import requests
+
+from cashpoint_client import CashPointClient
+from mock_server import MockCashPoint
+from reconcile import ReconcileWorker
+from status_events import WEBHOOK_SECRET_HEADER, SseListener, StatusEventHub, WebhookReceiver
+from storage import SqliteTransactionStore
+
+# 出金後すぐに処理中になり、少しあとで完了する機器
+MOCK_CONFIG = {"transitions": [["processing", 0], ["Success", 0.3]]}
+SECRET = "test-secret"
+
+
+# 条件を満たすまで待つ (満たせばTrue)
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+# 空いているポート番号
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# 代わりのサーバーで出金し、処理中の取引として保存する
+def withdraw(mock, store):
+    uuid = mock.refund(1000)
+    store.append({
+        "日時": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "応対者名": "テスト",
+        "お支払先": "テスト",
+        "勘定項目": "その他",
+        "出金金額": 1000,
+        "UUID": uuid,
+        "ステータス": "出金処理中",
+        "機器ID": "default"
+    })
+    return uuid
+
+
+# 代わりのサーバーを使ってステータス通知の各経路を確かめる
+class StatusEventsTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="cashpoint-test-")
+        self.store = SqliteTransactionStore(os.path.join(self.workdir, "transactions.db"))
+        self.hub = StatusEventHub(self.store)
+        self.mock = None
+
+    def tearDown(self):
+        self.hub.stop()
+        if self.mock is not None:
+            self.mock.stop()
+        self.store.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def status(self, uuid):
+        df = self.store.load()
+        return df.loc[df['UUID'] == uuid, 'ステータス'].iloc[0]
+
+    def test_sse(self):
+        self.mock = MockCashPoint(port=0, config=MOCK_CONFIG).start()
+        self.hub.start_source(SseListener(self.hub, "default", self.mock.base_url, reconnect_interval=0.1))
+        self.assertTrue(wait_for(self.hub.is_active))
+
+        uuid = withdraw(self.mock, self.store)
+        self.assertTrue(wait_for(lambda: self.status(uuid) == "完了"))
+        self.assertEqual(self.hub.health()['applied'], 1)
+
+    def test_webhook(self):
+        port = free_port()
+        url = f"http://127.0.0.1:{port}/callback/status"
+        self.hub.start_source(WebhookReceiver(self.hub, port=port, secret=SECRET, stale_after=1))
+        # 受信口を開いただけではつながったとみなさない
+        self.assertFalse(self.hub.is_active())
+
+        # シークレットがないか違うコールバックは受け付けない
+        event = {"uuid": "unknown", "status": "Success"}
+        self.assertEqual(requests.post(url, json=event, timeout=3).status_code, 401)
+        response = requests.post(url, json=event, headers={WEBHOOK_SECRET_HEADER: "wrong"}, timeout=3)
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(self.hub.is_active())
+        self.assertEqual(self.hub.health()['received'], 0)
+
+        self.mock = MockCashPoint(
+            port=0, config=MOCK_CONFIG, webhook_url=url, sse=False, webhook_secret=SECRET
+        ).start()
+        uuid = withdraw(self.mock, self.store)
+        self.assertTrue(wait_for(lambda: self.status(uuid) == "完了"))
+        self.assertTrue(self.hub.is_active())
+
+        # コールバックが途絶えたら照会に戻す
+        self.assertTrue(wait_for(lambda: not self.hub.is_active(), timeout=3))
+
+    def test_webhook_requires_secret(self):
+        with self.assertRaises(ValueError):
+            WebhookReceiver(self.hub, port=free_port())
+
+    def test_fallback_without_push(self):
+        self.mock = MockCashPoint(port=0, config=MOCK_CONFIG, sse=False).start()
+        self.hub.start_source(SseListener(self.hub, "default", self.mock.base_url, reconnect_interval=0.1))
+        self.assertTrue(wait_for(lambda: self.hub.health()['channels']['default']['state'] == "unsupported"))
+        self.assertFalse(self.hub.is_active())
+
+        client = CashPointClient(self.mock.base_url, max_retries=0)
+        worker = ReconcileWorker(
+            self.store, lambda uuid, machine_id: client.query(uuid),
+            initial_interval=0.1, max_interval=0.5, rescan_interval=0.1, push_active=self.hub.is_active
+        )
+        worker.start()
+        try:
+            uuid = withdraw(self.mock, self.store)
+            self.assertTrue(wait_for(lambda: self.status(uuid) == "完了"))
+        finally:
+            worker.stop()
+            client.close()
+
+
+if __name__ == "__main__":
+    unittest.main()